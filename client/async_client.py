@@ -0,0 +1,344 @@
+import asyncio
+import itertools
+import socket
+from client.client import backoff, optional, schedule, task_specs
+from shared.codec import DEFAULT_CODEC
+from shared.compression import DEFAULT_COMPRESSION
+from shared.encryption import DEFAULT_CIPHER, ClientHello, seal, unseal
+from shared.framing import DEFAULT_MAX_FRAME_SIZE, encode_frame, read_frame_async
+
+
+class AsyncClientConnection:
+    """asyncio counterpart of ClientConnection: one stream, many requests."""
+
+    def __init__(
+        self,
+        reader,
+        writer,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        codec=DEFAULT_CODEC,
+        session=None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_size = max_frame_size
+        self.codec = codec
+        self.session = session
+        self.pending = {}
+        self.closed = False
+        self.reader_task = asyncio.create_task(self.read_responses())
+
+    @classmethod
+    async def open(
+        cls,
+        server_host,
+        server_port,
+        max_frame_size,
+        codec=DEFAULT_CODEC,
+        cipher=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+    ):
+        reader, writer = await asyncio.open_connection(server_host, server_port)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        session = None
+        if cipher != "fernet":
+            hello = ClientHello(cipher, compression, max_message_size=max_frame_size)
+            writer.write(encode_frame(hello.frame, max_frame_size))
+            session = hello.finish(await read_frame_async(reader, max_frame_size))
+        return cls(reader, writer, max_frame_size, codec, session)
+
+    async def submit(self, request):
+        """Send request and return a Future for its reply."""
+        if self.closed:
+            raise ConnectionError("connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        future.connection = self
+        future.request_id = request["request_id"]
+        self.pending[request["request_id"]] = future
+        try:
+            if self.session:
+                encrypted_request = self.session.seal(request, self.codec)
+            else:
+                encrypted_request = seal(request, self.codec)
+            self.writer.write(encode_frame(encrypted_request, self.max_frame_size))
+            await self.writer.drain()
+        except Exception:
+            self.pending.pop(request["request_id"], None)
+            raise
+        return future
+
+    def forget(self, request_id):
+        self.pending.pop(request_id, None)
+
+    async def read_responses(self):
+        try:
+            while True:
+                encrypted_response = await read_frame_async(
+                    self.reader, self.max_frame_size
+                )
+                if not encrypted_response:
+                    break
+                if self.session:
+                    response = self.session.unseal(encrypted_response)
+                else:
+                    response = unseal(encrypted_response)
+                if response is None:
+                    print("Invalid server response")
+                    continue
+                future = self.pending.pop(response.get("request_id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if not self.closed:
+                print(f"Connection error: {e}")
+        finally:
+            self.fail_pending()
+
+    def fail_pending(self):
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection lost"))
+        self.writer.close()
+
+    async def close(self):
+        self.reader_task.cancel()
+        try:
+            await self.reader_task
+        except asyncio.CancelledError:
+            pass
+        self.fail_pending()
+
+
+class AsyncClient:
+    """Client for asyncio producers, with the same pooling and pipelining."""
+
+    def __init__(
+        self,
+        server_host="localhost",
+        server_port=5000,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        batch_size=1000,
+        pool_size=1,
+        timeout=10,
+        codec=DEFAULT_CODEC,
+        cipher=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+        busy_retries=5,
+        max_backoff=30,
+    ):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_frame_size = max_frame_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.codec = codec
+        self.cipher = cipher
+        self.compression = compression
+        self.busy_retries = busy_retries
+        self.max_backoff = max_backoff
+        self._pool = [None] * max(1, pool_size)
+        self._pool_lock = asyncio.Lock()
+        self._next_connection = itertools.count()
+        self._request_ids = itertools.count(1)
+
+    async def connection(self):
+        index = next(self._next_connection) % len(self._pool)
+        connection = self._pool[index]
+        if connection is not None and not connection.closed:
+            return connection
+        # Connect without the lock so one slow handshake does not hold up
+        # requests on the other slots.
+        connection = await AsyncClientConnection.open(
+            self.server_host,
+            self.server_port,
+            self.max_frame_size,
+            self.codec,
+            self.cipher,
+            self.compression,
+        )
+        current = self._pool[index]
+        if current is None or current.closed:
+            self._pool[index] = connection
+            return connection
+        # Another task reconnected this slot first.
+        await connection.close()
+        return current
+
+    async def submit(self, request):
+        """Pipeline request on a pooled connection and return a Future."""
+        request = dict(request, request_id=next(self._request_ids))
+        try:
+            return await (await self.connection()).submit(request)
+        except (OSError, ConnectionError) as e:
+            print(f"Connection error: {e}, reconnecting")
+            return await (await self.connection()).submit(request)
+
+    async def send_request(self, request, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        future = await self.submit(request)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            future.connection.forget(future.request_id)
+            raise TimeoutError(f"no reply within {timeout}s")
+
+    async def send_enqueue(self, request):
+        for attempt in itertools.count():
+            response = await self.send_request(request)
+            if (
+                response is None
+                or response.get("status") != "busy"
+                or attempt >= self.busy_retries
+            ):
+                return response
+            await asyncio.sleep(
+                backoff(response.get("retry_after", 1), attempt, self.max_backoff)
+            )
+
+    async def add_task(
+        self,
+        task_description,
+        priority=0,
+        timeout=300,
+        run_at=None,
+        delay=None,
+        idempotency_key=None,
+        queue=None,
+    ):
+        try:
+            response = await self.send_enqueue(
+                {
+                    "type": "add_task",
+                    "task": task_description,
+                    "priority": priority,
+                    "timeout": timeout,
+                    **schedule(run_at, delay),
+                    **optional(idempotency_key=idempotency_key, queue=queue),
+                }
+            )
+            if response is None:
+                return None
+            if response["status"] == "ok":
+                return response["task_id"]
+            print(f"Failed to add task: {response.get('message', 'unknown error')}")
+            return None
+        except Exception as e:
+            print(f"Error occurred while adding task: {e}")
+            return None
+
+    async def add_tasks(self, tasks, priority=0, timeout=300):
+        """Submit many tasks; the batches are pipelined rather than awaited in turn."""
+        specs = task_specs(tasks, priority, timeout)
+        try:
+            responses = await asyncio.gather(
+                *(
+                    self.send_enqueue(
+                        {
+                            "type": "add_tasks",
+                            "tasks": specs[start : start + self.batch_size],
+                        }
+                    )
+                    for start in range(0, len(specs), self.batch_size)
+                )
+            )
+            task_ids = []
+            for response in responses:
+                if response is None:
+                    return None
+                if response["status"] != "ok":
+                    print(
+                        f"Failed to add tasks: {response.get('message', 'unknown error')}"
+                    )
+                    return None
+                task_ids.extend(response["task_ids"])
+            return task_ids
+        except Exception as e:
+            print(f"Error occurred while adding tasks: {e}")
+            return None
+
+    async def get_task_result(self, task_id):
+        try:
+            response = await self.send_request(
+                {"type": "get_task_result", "task_id": task_id}
+            )
+            if response is None:
+                print(f"Invalid response for task {task_id}")
+                return None
+            if response["status"] == "ok":
+                return response["result"]
+            if response["status"] != "pending":
+                print(
+                    f"Failed to get result for task {task_id}: {response.get('message', 'unknown error')}"
+                )
+            return None
+        except Exception as e:
+            print(f"Error occurred while fetching result for task {task_id}: {e}")
+            return None
+
+    async def wait_result(self, task_id, timeout=60):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                response = await self.send_request(
+                    {"type": "wait_result", "task_id": task_id, "wait": remaining},
+                    timeout=remaining + self.timeout,
+                )
+                if response is None:
+                    print(f"Invalid response for task {task_id}")
+                    return None
+                if response["status"] == "ok":
+                    return response["result"]
+                if response["status"] != "pending":
+                    print(
+                        f"Failed to get result for task {task_id}: {response.get('message', 'unknown error')}"
+                    )
+                    return None
+        except Exception as e:
+            print(f"Error occurred while waiting for task {task_id}: {e}")
+            return None
+
+    async def dead_letters(self):
+        """Tasks that failed too often, as dicts with task_id, task and attempts."""
+        try:
+            response = await self.send_request({"type": "list_dead_letters"})
+            if response is None or response["status"] != "ok":
+                print("Failed to list dead letters")
+                return None
+            return response["tasks"]
+        except Exception as e:
+            print(f"Error occurred while listing dead letters: {e}")
+            return None
+
+    async def retry_dead_letter(self, task_id):
+        """Queue a dead-lettered task again; returns True if it was found."""
+        try:
+            response = await self.send_request(
+                {"type": "retry_dead_letter", "task_id": task_id}
+            )
+            return response is not None and response["status"] == "ok"
+        except Exception as e:
+            print(f"Error occurred while retrying task {task_id}: {e}")
+            return False
+
+    async def close(self):
+        async with self._pool_lock:
+            for index, connection in enumerate(self._pool):
+                if connection:
+                    await connection.close()
+                self._pool[index] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -1,83 +1,426 @@
+import itertools
 import socket
-import json
 import random
+import threading
 import time
-from shared.encryption import encrypt_message, decrypt_message, add_hmac, verify_hmac
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from shared.codec import DEFAULT_CODEC
+from shared.compression import DEFAULT_COMPRESSION
+from shared.encryption import DEFAULT_CIPHER, ClientHello, seal, unseal
+from shared.framing import DEFAULT_MAX_FRAME_SIZE, FrameReader, send_frame
+
+
+class ClientConnection:
+    """A persistent connection that can carry many requests at once.
+
+    Every request carries a request_id, and a reader thread hands each reply
+    to the future registered under that id, so callers can pipeline requests
+    without waiting for earlier replies. Unless cipher is "fernet", the
+    connection opens an AEAD session first, compressing large messages
+    unless compression is "none".
+    """
+
+    def __init__(
+        self,
+        server_host,
+        server_port,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        codec=DEFAULT_CODEC,
+        cipher=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+    ):
+        self.sock = socket.create_connection((server_host, server_port), timeout=10)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.max_frame_size = max_frame_size
+        self.codec = codec
+        self.reader = FrameReader(self.sock, max_frame_size)
+        self.session = None
+        if cipher != "fernet":
+            hello = ClientHello(cipher, compression, max_message_size=max_frame_size)
+            send_frame(self.sock, hello.frame, max_frame_size)
+            self.session = hello.finish(self.reader.read_frame())
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        reader_thread = threading.Thread(target=self.read_responses)
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def submit(self, request):
+        """Send request and return a Future for its reply."""
+        future = Future()
+        future.connection = self
+        future.request_id = request["request_id"]
+        if self.session:
+            payload = self.session.encode(request, self.codec)
+        else:
+            payload = seal(request, self.codec)
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection is closed")
+            self.pending[request["request_id"]] = future
+            try:
+                # Session nonces must go out in the order they are used.
+                if self.session:
+                    payload = self.session.encrypt(payload)
+                send_frame(self.sock, payload, self.max_frame_size)
+            except Exception:
+                self.pending.pop(request["request_id"], None)
+                raise
+        return future
+
+    def forget(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def read_responses(self):
+        try:
+            while True:
+                encrypted_response = self.reader.read_frame()
+                if not encrypted_response:
+                    break
+                if self.session:
+                    response = self.session.unseal(encrypted_response)
+                else:
+                    response = unseal(encrypted_response)
+                if response is None:
+                    print("Invalid server response")
+                    continue
+                with self.lock:
+                    future = self.pending.pop(response.get("request_id"), None)
+                if future is not None:
+                    future.set_result(response)
+        except Exception as e:
+            if not self.closed:
+                print(f"Connection error: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("connection lost"))
+        try:
+            self.sock.close()
+        except:
+            pass
+
+
+def schedule(run_at=None, delay=None):
+    """The fields holding a task back until run_at, or for delay seconds."""
+    fields = {}
+    if run_at is not None:
+        fields["run_at"] = run_at
+    if delay is not None:
+        fields["delay"] = delay
+    return fields
+
+
+def backoff(retry_after, attempt, max_backoff=30):
+    """Seconds to wait before retrying a busy reply.
+
+    At least the server's retry_after, plus a random share of a window that
+    doubles with each attempt, so refused producers do not come back in step.
+    """
+    retry_after = max(0.0, float(retry_after))
+    return retry_after + random.uniform(0, min(max_backoff, retry_after * 2**attempt))
+
+
+def optional(**fields):
+    """The fields that are set, for requests that omit the rest."""
+    return {name: value for name, value in fields.items() if value is not None}
+
+
+def task_specs(tasks, priority, timeout):
+    specs = []
+    for item in tasks:
+        if isinstance(item, dict):
+            specs.append(
+                {
+                    "task": item["task"],
+                    "priority": item.get("priority", priority),
+                    "timeout": item.get("timeout", timeout),
+                    **schedule(item.get("run_at"), item.get("delay")),
+                    **optional(
+                        idempotency_key=item.get("idempotency_key"),
+                        queue=item.get("queue"),
+                    ),
+                }
+            )
+        else:
+            specs.append({"task": item, "priority": priority, "timeout": timeout})
+    return specs
 
 
 class Client:
-    def __init__(self, server_host="localhost", server_port=5000):
+    def __init__(
+        self,
+        server_host="localhost",
+        server_port=5000,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        batch_size=1000,
+        pool_size=4,
+        timeout=10,
+        codec=DEFAULT_CODEC,
+        cipher=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+        busy_retries=5,
+        max_backoff=30,
+    ):
         self.server_host = server_host
         self.server_port = server_port
+        self.max_frame_size = max_frame_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.codec = codec
+        self.cipher = cipher
+        self.compression = compression
+        self.busy_retries = busy_retries
+        self.max_backoff = max_backoff
+        self._pool = [None] * max(1, pool_size)
+        self._pool_lock = threading.Lock()
+        self._next_connection = itertools.count()
+        self._request_ids = itertools.count(1)
+
+    def connection(self):
+        """Return a live pooled connection, reconnecting a dead slot if needed."""
+        index = next(self._next_connection) % len(self._pool)
+        with self._pool_lock:
+            connection = self._pool[index]
+        if connection is not None and not connection.closed:
+            return connection
+        # Connect without the lock so one slow handshake does not hold up
+        # requests on the other slots.
+        connection = ClientConnection(
+            self.server_host,
+            self.server_port,
+            self.max_frame_size,
+            self.codec,
+            self.cipher,
+            self.compression,
+        )
+        with self._pool_lock:
+            current = self._pool[index]
+            if current is None or current.closed:
+                self._pool[index] = connection
+                return connection
+        # Another thread reconnected this slot first.
+        connection.close()
+        return current
 
-    def add_task(self, task_description, priority=0, timeout=300):
+    def submit(self, request):
+        """Pipeline request on a pooled connection and return a Future.
+
+        A request that could not be written is retried once on a fresh
+        connection; one that was written is never resent.
+        """
+        request = dict(request, request_id=next(self._request_ids))
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(10)
-                sock.connect((self.server_host, self.server_port))
-                request = add_hmac(
-                    {
-                        "type": "add_task",
-                        "task": task_description,
-                        "priority": priority,
-                        "timeout": timeout,
-                    }
+            return self.connection().submit(request)
+        except (OSError, ConnectionError) as e:
+            print(f"Connection error: {e}, reconnecting")
+            return self.connection().submit(request)
+
+    def send_request(self, request, timeout=None):
+        """Send request and wait for its verified reply (None if invalid)."""
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(request)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.connection.forget(future.request_id)
+            raise TimeoutError(f"no reply within {timeout}s")
+
+    def send_enqueue(self, request):
+        """send_request, backing off and retrying while the server is busy.
+
+        A busy server enqueued nothing, so retrying cannot add a task twice.
+        """
+        for attempt in itertools.count():
+            response = self.send_request(request)
+            if (
+                response is None
+                or response.get("status") != "busy"
+                or attempt >= self.busy_retries
+            ):
+                return response
+            time.sleep(
+                backoff(response.get("retry_after", 1), attempt, self.max_backoff)
+            )
+
+    def close(self):
+        with self._pool_lock:
+            for index, connection in enumerate(self._pool):
+                if connection:
+                    connection.close()
+                self._pool[index] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_task(
+        self,
+        task_description,
+        priority=0,
+        timeout=300,
+        run_at=None,
+        delay=None,
+        idempotency_key=None,
+        queue=None,
+    ):
+        """Enqueue a task; with run_at (epoch seconds) or delay (seconds) it
+        is held back until then, and timeout counts from that point.
+
+        Retrying with the same idempotency_key returns the first attempt's
+        task_id instead of enqueueing the task again. queue names the
+        tenant or queue the task belongs to, which a server in fair dispatch
+        mode shares dispatches between.
+        """
+        try:
+            response = self.send_enqueue(
+                {
+                    "type": "add_task",
+                    "task": task_description,
+                    "priority": priority,
+                    "timeout": timeout,
+                    **schedule(run_at, delay),
+                    **optional(idempotency_key=idempotency_key, queue=queue),
+                }
+            )
+            print(response)
+            if response is None:
+                return None
+
+            # Handle server response
+            if response["status"] == "ok":
+                print(
+                    f"Task added: {response['task_id']} with priority {priority} and timeout {timeout}"
                 )
-                encrypted_request = encrypt_message(request)
-                sock.sendall(encrypted_request)
+                return response["task_id"]
+            else:
+                print(f"Failed to add task: {response.get('message', 'unknown error')}")
+                return None
 
-                encrypted_response = sock.recv(1024)
-                response = decrypt_message(encrypted_response)
-                print(response)
+        except Exception as e:
 
-                # Verify HMAC
-                if not verify_hmac(response):
-                    print("Invalid HMAC in server response")
-                    return None
+            print(f"Error occurred while adding task: {e}")
+            return None
 
-                # Handle server response
-                if response["status"] == "ok":
-                    print(
-                        f"Task added: {response['task_id']} with priority {priority} and timeout {timeout}"
-                    )
-                    return response["task_id"]
-                else:
+    def add_tasks(self, tasks, priority=0, timeout=300):
+        """Submit many tasks in one request.
+
+        Each item is a task description, or a dict with "task" and optional
+        "priority" and "timeout" overriding the defaults and "run_at",
+        "delay", "idempotency_key" or "queue" as for add_task. Returns the task
+        ids in submission order, or None on failure. Lists longer than
+        batch_size go out as several requests. Requests a busy server turns
+        away are retried up to busy_retries times with jittered backoff.
+        """
+        specs = task_specs(tasks, priority, timeout)
+        task_ids = []
+        try:
+            for start in range(0, len(specs), self.batch_size):
+                response = self.send_enqueue(
+                    {
+                        "type": "add_tasks",
+                        "tasks": specs[start : start + self.batch_size],
+                    }
+                )
+                if response is None:
+                    return None
+                if response["status"] != "ok":
                     print(
-                        f"Failed to add task: {response.get('message', 'unknown error')}"
+                        f"Failed to add tasks: {response.get('message', 'unknown error')}"
                     )
                     return None
-
+                task_ids.extend(response["task_ids"])
+            print(f"Added {len(task_ids)} tasks")
+            return task_ids
         except Exception as e:
-
-            print(f"Error occurred while adding task: {e}")
+            print(f"Error occurred while adding tasks: {e}")
             return None
 
     def get_task_result(self, task_id):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect((self.server_host, self.server_port))
-                request = add_hmac({"type": "get_task_result", "task_id": task_id})
-                encrypted_request = encrypt_message(request)
-                sock.sendall(encrypted_request)
+            response = self.send_request(
+                {"type": "get_task_result", "task_id": task_id}
+            )
+            if response is None:
+                print(f"Invalid response for task {task_id}")
+                return None
+
+            if response["status"] == "ok":
+                return response["result"]
+            elif response["status"] != "pending":
+                print(
+                    f"Failed to get result for task {task_id}: {response.get('message', 'unknown error')}"
+                )
+            return None
+        except Exception as e:
+            print(f"Error occurred while fetching result for task {task_id}: {e}")
+            return None
 
-                encrypted_response = sock.recv(1024)
-                response = decrypt_message(encrypted_response)
+    def wait_result(self, task_id, timeout=60):
+        """Block until the task's result arrives or timeout seconds pass.
 
-                if not verify_hmac(response):
-                    print(f"Invalid HMAC for task {task_id}")
+        The server holds each request open until the result is stored, so
+        this does not busy-poll.
+        """
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                response = self.send_request(
+                    {"type": "wait_result", "task_id": task_id, "wait": remaining},
+                    timeout=remaining + self.timeout,
+                )
+                if response is None:
+                    print(f"Invalid response for task {task_id}")
                     return None
-
                 if response["status"] == "ok":
                     return response["result"]
-                else:
+                if response["status"] != "pending":
                     print(
                         f"Failed to get result for task {task_id}: {response.get('message', 'unknown error')}"
                     )
                     return None
         except Exception as e:
-            print(f"Error occurred while fetching result for task {task_id}: {e}")
+            print(f"Error occurred while waiting for task {task_id}: {e}")
             return None
 
+    def dead_letters(self):
+        """Tasks that failed too often, as dicts with task_id, task and attempts."""
+        try:
+            response = self.send_request({"type": "list_dead_letters"})
+            if response is None or response["status"] != "ok":
+                print("Failed to list dead letters")
+                return None
+            return response["tasks"]
+        except Exception as e:
+            print(f"Error occurred while listing dead letters: {e}")
+            return None
+
+    def retry_dead_letter(self, task_id):
+        """Queue a dead-lettered task again; returns True if it was found."""
+        try:
+            response = self.send_request(
+                {"type": "retry_dead_letter", "task_id": task_id}
+            )
+            return response is not None and response["status"] == "ok"
+        except Exception as e:
+            print(f"Error occurred while retrying task {task_id}: {e}")
+            return False
+
 
 if __name__ == "__main__":
     client = Client()
@@ -92,11 +435,11 @@ if __name__ == "__main__":
         if task_id:
             task_ids.append(task_id)
 
-    time.sleep(15)
-
     for task_id in task_ids:
-        result = client.get_task_result(task_id)
+        result = client.wait_result(task_id, timeout=15)
         if result:
             print(f"task {task_id} result: {result}")
         else:
             print(f"task {task_id} has no result yet")
+
+    client.close()
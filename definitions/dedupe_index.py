@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import deque
+
+
+class DedupeIndex:
+    """Idempotency keys mapped to the task_id first enqueued under them.
+
+    Keys live for ttl seconds, and at most max_keys are kept. Since every
+    key gets the same ttl, insertion order is expiry order, so a ring of
+    (expires_at, key) in insertion order finds both the expired keys and
+    the oldest ones to drop when full, without scanning the map.
+    """
+
+    def __init__(self, ttl=3600, max_keys=1000000):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.task_ids = {}
+        self.ring = deque()
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def claim(self, key, task_id, now=None):
+        """Record key for task_id; returns the task_id already holding it, or None."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._evict(now)
+            entry = self.task_ids.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            expires_at = now + self.ttl
+            self.task_ids[key] = (task_id, expires_at)
+            self.ring.append((expires_at, key))
+            return None
+
+    def release(self, key, task_id):
+        """Forget key if task_id still holds it, e.g. after a failed enqueue."""
+        with self._lock:
+            entry = self.task_ids.get(key)
+            if entry is not None and entry[0] == task_id:
+                del self.task_ids[key]
+
+    def restore(self, key, task_id, claimed_at):
+        """Re-add a key from the log; keys past their ttl are skipped."""
+        expires_at = claimed_at + self.ttl
+        with self._lock:
+            if expires_at > time.time():
+                self.task_ids[key] = (task_id, expires_at)
+                self.ring.append((expires_at, key))
+
+    def _evict(self, now):
+        ring = self.ring
+        while ring and (ring[0][0] <= now or len(self.task_ids) >= self.max_keys):
+            expires_at, key = ring.popleft()
+            entry = self.task_ids.get(key)
+            # A key claimed again after expiring has a newer ring entry.
+            if entry is not None and entry[1] == expires_at:
+                del self.task_ids[key]
+
+    def __len__(self):
+        return len(self.task_ids)
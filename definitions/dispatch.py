@@ -0,0 +1,120 @@
+import threading
+import time
+from .priority_task import SEQ_BITS, make_rank
+
+# Fractional levels are kept as integers in these units.
+LEVEL_SCALE = 1 << 20
+# Default fair weights are 2 ** priority for priorities within this many
+# levels of 0; beyond it they stay at the bound.
+PRIORITY_LIMIT = 64
+# Upper bound on a task's virtual cost, reached by vanishing weights.
+MAX_COST = LEVEL_SCALE << 64
+
+
+class StrictPriority:
+    """Highest priority first, FIFO within a priority.
+
+    With aging, a queued task gains aging priority levels per second it has
+    been ready. Since every task ages at the same rate, ranking by
+    ready time * aging - priority orders them the same at any later moment,
+    so ranks are fixed at enqueue and the heap never has to be re-sorted.
+    """
+
+    def __init__(self, aging=0):
+        self.aging = aging
+
+    def rank(self, task, seq):
+        if not self.aging:
+            return make_rank(task.priority, seq)
+        level = round((task.ready_at() * self.aging - task.priority) * LEVEL_SCALE)
+        return (level << SEQ_BITS) | seq
+
+    def dequeued(self, tasks):
+        pass
+
+
+class WeightedFair:
+    """Weighted fair queuing across flows, one per (queue, priority).
+
+    Each task is stamped with a virtual finish time: the later of its flow's
+    last finish and the virtual clock, plus 1 / weight. Serving the lowest
+    stamp first gives each backlogged flow a share of dispatches in
+    proportion to its weight, and FIFO order within it. A flow's stamps
+    only run ahead of the clock by its own backlog, so a low-weight flow
+    waits at most that long however much other traffic arrives; that is
+    the aging. The stamp goes in the rank's level, so the shard heaps and
+    their O(log n) dequeue are unchanged.
+
+    A flow's weight is its priority's weight (default 2 ** priority, with
+    priority clamped to +-PRIORITY_LIMIT) times its queue's (default 1).
+    """
+
+    def __init__(self, weights=None, queue_weights=None):
+        self.weights = dict(weights or {})
+        self.queue_weights = dict(queue_weights or {})
+        if any(w <= 0 for w in [*self.weights.values(), *self.queue_weights.values()]):
+            raise ValueError("weights must be positive")
+        # Virtual clock: the highest stamp dispatched so far.
+        self.clock = 0
+        self.finish = {}
+        self._lock = threading.Lock()
+
+    def weight(self, task):
+        weight = self.weights.get(task.priority)
+        if weight is None:
+            weight = 2.0 ** max(-PRIORITY_LIMIT, min(PRIORITY_LIMIT, task.priority))
+        return weight * self.queue_weights.get(task.queue, 1)
+
+    def cost(self, task):
+        """Virtual time a task of this flow takes: 1 / weight, in level units."""
+        weight = self.weight(task)
+        if weight * MAX_COST <= LEVEL_SCALE:
+            return MAX_COST
+        return max(1, round(LEVEL_SCALE / weight))
+
+    def rank(self, task, seq):
+        if task.run_at is not None and task.run_at > time.time():
+            # Ranked again when promoted; charging the flow now as well
+            # would hold back its other tasks.
+            return seq
+        cost = self.cost(task)
+        flow = (task.queue, task.priority)
+        with self._lock:
+            stamp = max(self.clock, self.finish.get(flow, 0)) + cost
+            self.finish[flow] = stamp
+            if len(self.finish) > 4096:
+                # Flows with nothing queued restart from the clock anyway.
+                self.finish = {
+                    key: value
+                    for key, value in self.finish.items()
+                    if value > self.clock
+                }
+        return (stamp << SEQ_BITS) | seq
+
+    def dequeued(self, tasks):
+        if not tasks:
+            return
+        stamp = max(task.rank for task in tasks) >> SEQ_BITS
+        if stamp > self.clock:
+            with self._lock:
+                self.clock = max(self.clock, stamp)
+
+
+DISPATCH = {"strict": StrictPriority, "fair": WeightedFair}
+DEFAULT_DISPATCH = "strict"
+
+
+def get_dispatch(name, **options):
+    try:
+        return DISPATCH[name](**options)
+    except KeyError:
+        raise ValueError(f"unknown dispatch mode: {name}")
+
+
+def parse_weights(spec, key=str):
+    """Parse name:weight pairs like 0:1,2:4 into a dict."""
+    weights = {}
+    for part in filter(None, spec.split(",")):
+        name, _, weight = part.rpartition(":")
+        weights[key(name)] = float(weight)
+    return weights
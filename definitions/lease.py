@@ -0,0 +1,8 @@
+class Lease:
+    __slots__ = ("task", "owner", "deadline", "leased_at")
+
+    def __init__(self, task, owner, deadline, leased_at=None):
+        self.task = task
+        self.owner = owner
+        self.deadline = deadline
+        self.leased_at = leased_at
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+
+_ROTATE = object()
+
+
+class TaskLog:
+    """Segmented append-only log of queue operations with group commit.
+
+    Records are appended from any thread and written by a single flusher
+    thread, which batches everything that piled up during the previous fsync
+    into one write + fsync. A snapshot file plus the segments after it are
+    enough to rebuild the queue.
+    """
+
+    def __init__(
+        self,
+        snapshot_file="tasks.json",
+        log_dir=None,
+        segment_size=16 * 1024 * 1024,
+        compact_threshold=50000,
+        fsync=True,
+    ):
+        self.snapshot_file = snapshot_file
+        self.log_dir = log_dir or f"{snapshot_file}.wal"
+        self.segment_size = segment_size
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.records_since_snapshot = 0
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._seq = 0
+        self._durable_seq = 0
+        self._segment_bytes = 0
+        self._closed = False
+        self._file = None
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 0
+        if segments:
+            self._segment_bytes = os.path.getsize(self.segment_path(self._segment))
+
+        self._flusher = threading.Thread(target=self._flush_loop, args=(self._segment,))
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.log_dir, f"{segment:08d}.log")
+
+    def segments(self):
+        return sorted(
+            int(name[:-4])
+            for name in os.listdir(self.log_dir)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+
+    def append(self, op, **fields):
+        return self.append_many(op, [fields])
+
+    def append_many(self, op, records):
+        """Append one op per record as a single write; returns its seq."""
+        lines = []
+        for fields in records:
+            fields["op"] = op
+            lines.append(json.dumps(fields))
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._cond:
+            if self._closed:
+                raise ValueError("task log is closed")
+            self._segment_bytes += len(data)
+            if self._segment_bytes > self.segment_size:
+                self._rotate_locked()
+                self._segment_bytes = len(data)
+            self._pending.append(data)
+            self._seq += 1
+            self.records_since_snapshot += len(records)
+            self._cond.notify_all()
+            return self._seq
+
+    def rotate(self):
+        """Start a new segment; returns (segment, seq) for a snapshot cut."""
+        with self._cond:
+            segment = self._rotate_locked()
+            self._segment_bytes = 0
+            self.records_since_snapshot = 0
+            self._cond.notify_all()
+            return segment, self._seq
+
+    def _rotate_locked(self):
+        self._segment += 1
+        self._pending.append(_ROTATE)
+        return self._segment
+
+    def wait(self, seq, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._durable_seq >= seq or self._closed, timeout
+            )
+
+    def needs_compaction(self):
+        return self.records_since_snapshot >= self.compact_threshold
+
+    def _flush_loop(self, segment):
+        self._file = open(self.segment_path(segment), "ab")
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                batch, self._pending = self._pending, []
+                seq = self._seq
+                closed = self._closed
+
+            chunk = []
+            for item in batch:
+                if item is _ROTATE:
+                    self._write(chunk)
+                    chunk = []
+                    self._file.close()
+                    segment += 1
+                    self._file = open(self.segment_path(segment), "ab")
+                else:
+                    chunk.append(item)
+            self._write(chunk)
+
+            with self._cond:
+                self._durable_seq = seq
+                self._cond.notify_all()
+            if closed and not batch:
+                self._file.close()
+                return
+
+    def _write(self, chunk):
+        if chunk:
+            self._file.write(b"".join(chunk))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def write_snapshot(self, state, segment, seq):
+        """Persist state as of (segment, seq) and drop the segments it covers."""
+        self.wait(seq)
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(dict(state, segment=segment), f)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        for old in self.segments():
+            if old < segment:
+                try:
+                    os.remove(self.segment_path(old))
+                except OSError as e:
+                    print(f"Error removing log segment {old}: {e}")
+
+    def replay(self):
+        """Return the snapshot state and the log records written after it."""
+        state, start = {}, 0
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, "r") as f:
+                data = json.load(f)
+            # Pre-log snapshots are a bare list of tasks.
+            if isinstance(data, list):
+                state = {"tasks": data}
+            else:
+                state, start = data, data.pop("segment")
+
+        records = []
+        for segment in self.segments():
+            if segment < start:
+                continue
+            with open(self.segment_path(segment), "rb") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Torn write at the tail of a segment after a crash.
+                        print(f"Skipping corrupt record in log segment {segment}")
+        return state, records
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._flusher.join(timeout=5)
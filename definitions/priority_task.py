@@ -1,15 +1,89 @@
 import time
 
+# Low bits of a rank hold the enqueue sequence number, the rest the dispatch
+# level: -priority under strict priority (see definitions.dispatch).
+SEQ_BITS = 40
+
+
+def make_rank(priority, seq):
+    """Pack (-priority, seq) into one int so heaps compare plain ints."""
+    return (-priority << SEQ_BITS) | seq
+
 
 class PriorityTask:
-    def __init__(self, priority, task_id, task, timeout):
+    """A queued task. Heaps hold only its rank; the task itself, payload
+    included, lives in a map keyed by that rank.
+
+    A task with run_at is held back until then, and its timeout counts from
+    run_at rather than from when it was enqueued. queue names the tenant or
+    queue it was added to, for fair dispatch; None is the default queue.
+    """
+
+    __slots__ = (
+        "priority",
+        "task_id",
+        "task",
+        "timestamp",
+        "timeout",
+        "attempts",
+        "rank",
+        "run_at",
+        "idempotency_key",
+        "queue",
+    )
+
+    def __init__(
+        self,
+        priority,
+        task_id,
+        task,
+        timeout,
+        run_at=None,
+        idempotency_key=None,
+        queue=None,
+    ):
         self.priority = priority
         self.task_id = task_id
         self.task = task
         self.timestamp = time.time()
         self.timeout = timeout
+        self.attempts = 0
+        # Set by the queue's dispatch when the task is enqueued.
+        self.rank = None
+        self.run_at = run_at
+        self.idempotency_key = idempotency_key
+        self.queue = queue
+
+    def ready_at(self):
+        return self.timestamp if self.run_at is None else self.run_at
+
+    def expires_at(self):
+        return self.ready_at() + self.timeout
+
+    def to_record(self):
+        return {
+            "priority": self.priority,
+            "task_id": self.task_id,
+            "task": self.task,
+            "timestamp": self.timestamp,
+            "timeout": self.timeout,
+            "attempts": self.attempts,
+            "run_at": self.run_at,
+            "idempotency_key": self.idempotency_key,
+            "queue": self.queue,
+        }
 
-    def __lt__(self, other):
-        if self.priority == other.priority:
-            return self.timestamp < other.timestamp
-        return self.priority > other.priority
+    @classmethod
+    def from_record(cls, task_data):
+        task = cls(
+            task_data["priority"],
+            task_data["task_id"],
+            task_data["task"],
+            task_data["timeout"],
+            task_data.get("run_at"),
+            task_data.get("idempotency_key"),
+            task_data.get("queue"),
+        )
+        task.timestamp = task_data["timestamp"]
+        task.attempts = task_data.get("attempts", 0)
+        return task
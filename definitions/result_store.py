@@ -0,0 +1,168 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultWaiter:
+    """A parked wait_result call; put hands the result straight to it."""
+
+    def __init__(self):
+        self.result = None
+        self.event = threading.Event()
+
+    def deliver(self, result):
+        self.result = result
+        self.event.set()
+
+
+class ResultEntry:
+    __slots__ = ("result", "path", "size", "expires_at")
+
+    def __init__(self, result, path, size, expires_at):
+        self.result = result
+        self.path = path
+        self.size = size
+        self.expires_at = expires_at
+
+
+class ResultStore:
+    """Bounded store of task results with TTL eviction.
+
+    Every entry lives for the same ttl, so insertion order is expiry order
+    and both expiry and the size caps evict from the front in O(1). Results
+    larger than spill_threshold are written to spill_dir, when one is set,
+    and only count against max_entries.
+    """
+
+    def __init__(
+        self,
+        ttl=3600,
+        max_entries=100000,
+        max_bytes=64 * 1024 * 1024,
+        spill_dir=None,
+        spill_threshold=64 * 1024,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+        self.entries = OrderedDict()
+        self.waiters = {}
+        self.bytes_used = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self._spill_ids = itertools.count()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def put(self, task_id, result):
+        """Store result; raises ValueError if it is not JSON-serializable."""
+        try:
+            encoded = json.dumps(result)
+        except TypeError as e:
+            raise ValueError(f"result is not JSON-serializable: {e}")
+        path = None
+        if self.spill_dir and len(encoded) > self.spill_threshold:
+            path = self._spill_path(task_id)
+            with open(path, "w") as f:
+                f.write(encoded)
+            result = None
+        entry = ResultEntry(result, path, len(encoded), time.time() + self.ttl)
+
+        with self.lock:
+            self._discard(task_id)
+            self.entries[task_id] = entry
+            if path is None:
+                self.bytes_used += entry.size
+            self._evict()
+            waiters = self.waiters.pop(task_id, ())
+        for waiter in waiters:
+            waiter.deliver(self._load(entry))
+
+    def get(self, task_id):
+        """Return (found, result)."""
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None or entry.expires_at < time.time():
+                return False, None
+        return True, self._load(entry)
+
+    def get_or_park(self, task_id, waiter):
+        """Return (found, result), parking waiter if the result isn't in yet."""
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None or entry.expires_at < time.time():
+                self.waiters.setdefault(task_id, []).append(waiter)
+                return False, None
+        return True, self._load(entry)
+
+    def cancel_wait(self, task_id, waiter):
+        """Unpark waiter; returns False if a result was already delivered to it."""
+        with self.lock:
+            waiters = self.waiters.get(task_id, [])
+            if waiter not in waiters:
+                return False
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiters[task_id]
+            return True
+
+    def wait(self, task_id, timeout):
+        waiter = ResultWaiter()
+        found, result = self.get_or_park(task_id, waiter)
+        if found:
+            return True, result
+        waiter.event.wait(timeout)
+        if self.cancel_wait(task_id, waiter):
+            return False, None
+        return True, waiter.result
+
+    def _spill_path(self, task_id):
+        # task_ids come from clients, so they are hashed rather than used as
+        # file names, and every put gets its own file: storing a result again
+        # discards the old entry's file, which must not be the new one.
+        digest = hashlib.sha256(str(task_id).encode()).hexdigest()
+        return os.path.join(self.spill_dir, f"{digest}.{next(self._spill_ids)}.json")
+
+    def _load(self, entry):
+        if entry.path is None:
+            return entry.result
+        try:
+            with open(entry.path, "r") as f:
+                return json.load(f)
+        except OSError as e:
+            print(f"Error reading spilled result {entry.path}: {e}")
+            return None
+
+    def _discard(self, task_id):
+        entry = self.entries.pop(task_id, None)
+        if entry is None:
+            return
+        if entry.path is None:
+            self.bytes_used -= entry.size
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        now = time.time()
+        while self.entries:
+            task_id, entry = next(iter(self.entries.items()))
+            if (
+                entry.expires_at >= now
+                and len(self.entries) <= self.max_entries
+                and self.bytes_used <= self.max_bytes
+            ):
+                break
+            self._discard(task_id)
+            self.evicted += 1
+
+    def __len__(self):
+        return len(self.entries)
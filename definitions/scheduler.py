@@ -0,0 +1,153 @@
+import itertools
+from collections import OrderedDict
+
+
+def expected_wait(worker):
+    """Seconds a new task would likely wait on worker before it is done.
+
+    Tasks ahead of it plus itself, at the worker's observed service time,
+    spread over its declared capacity. Workers with no completions yet score
+    zero so they get tried.
+    """
+    if worker is None or worker.service_time is None:
+        return 0.0
+    return (worker.task_count + 1) * worker.service_time / max(1, worker.capacity or 1)
+
+
+class FifoScheduler:
+    """Parked waiters served in the order they parked."""
+
+    def __init__(self):
+        self.waiters = OrderedDict()
+
+    def add(self, waiter):
+        self.waiters[waiter] = None
+
+    def remove(self, waiter):
+        """Returns False if waiter was not parked."""
+        return self.waiters.pop(waiter, False) is None
+
+    def peek(self):
+        return next(iter(self.waiters), None)
+
+    def pop(self):
+        return self.waiters.popitem(last=False)[0]
+
+    def is_parked(self, owner):
+        return False
+
+    def reschedule(self, owner):
+        pass
+
+    def __len__(self):
+        return len(self.waiters)
+
+
+class LeastLoadedScheduler:
+    """Parked waiters served lowest score first, by default expected_wait.
+
+    Waiters live in a binary heap with each one's position indexed, so a
+    worker whose load changes while it is parked is re-sifted in place
+    instead of the heap being rebuilt or scanned. Equal scores go in the
+    order they parked.
+    """
+
+    def __init__(self, score=expected_wait):
+        self.score = score
+        self.heap = []
+        self.positions = {}
+        self.by_owner = {}
+        self.order = itertools.count()
+
+    def add(self, waiter):
+        entry = [self.score(waiter.owner), next(self.order), waiter]
+        self.positions[waiter] = len(self.heap)
+        self.heap.append(entry)
+        self._sift_up(len(self.heap) - 1)
+        if waiter.owner is not None:
+            self.by_owner[id(waiter.owner)] = waiter
+
+    def remove(self, waiter):
+        """Returns False if waiter was not parked."""
+        index = self.positions.pop(waiter, None)
+        if index is None:
+            return False
+        if waiter.owner is not None and self.by_owner.get(id(waiter.owner)) is waiter:
+            del self.by_owner[id(waiter.owner)]
+        last = self.heap.pop()
+        if index < len(self.heap):
+            self.heap[index] = last
+            self.positions[last[2]] = index
+            self._sift(index)
+        return True
+
+    def peek(self):
+        return self.heap[0][2] if self.heap else None
+
+    def pop(self):
+        waiter = self.heap[0][2]
+        self.remove(waiter)
+        return waiter
+
+    def is_parked(self, owner):
+        return id(owner) in self.by_owner
+
+    def reschedule(self, owner):
+        """Re-score owner's parked waiter after its load changed."""
+        waiter = self.by_owner.get(id(owner))
+        if waiter is None:
+            return
+        index = self.positions[waiter]
+        self.heap[index][0] = self.score(owner)
+        self._sift(index)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _sift(self, index):
+        if index > 0 and self.heap[index] < self.heap[(index - 1) // 2]:
+            self._sift_up(index)
+        else:
+            self._sift_down(index)
+
+    def _sift_up(self, index):
+        heap = self.heap
+        entry = heap[index]
+        while index > 0:
+            parent = (index - 1) // 2
+            if not entry < heap[parent]:
+                break
+            heap[index] = heap[parent]
+            self.positions[heap[index][2]] = index
+            index = parent
+        heap[index] = entry
+        self.positions[entry[2]] = index
+
+    def _sift_down(self, index):
+        heap = self.heap
+        entry = heap[index]
+        size = len(heap)
+        while True:
+            child = 2 * index + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < entry:
+                break
+            heap[index] = heap[child]
+            self.positions[heap[index][2]] = index
+            index = child
+        heap[index] = entry
+        self.positions[entry[2]] = index
+
+
+SCHEDULERS = {"fifo": FifoScheduler, "least-loaded": LeastLoadedScheduler}
+DEFAULT_SCHEDULER = "least-loaded"
+
+
+def get_scheduler(name):
+    try:
+        return SCHEDULERS[name]()
+    except KeyError:
+        raise ValueError(f"unknown scheduler: {name}")
@@ -1,78 +1,463 @@
-import heapq
+import itertools
 import time
-import json
-import os
 import threading
 import uuid
-from .priority_task import PriorityTask
+from contextlib import ExitStack
+from .dedupe_index import DedupeIndex
+from .dispatch import DEFAULT_DISPATCH, get_dispatch
+from .persistence import TaskLog
+from .priority_task import SEQ_BITS, PriorityTask
+from .scheduler import DEFAULT_SCHEDULER, get_scheduler
+from .task_shard import TaskShard
+from .worker_registry import WorkerRegistry
+
+
+class TaskWaiter:
+    """A parked get_task call; add_task hands the next task straight to it."""
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self.task = None
+        self.event = threading.Event()
+
+    def deliver(self, task):
+        self.task = task
+        self.event.set()
 
 
 class TaskQueue:
-    def __init__(self, persistence_file="tasks.json"):
-        self.tasks = []
-        self.workers = []
-        self.lock = threading.Lock()
+    """Priority queue split into shards that each have their own lock.
+
+    Each task hashes to one shard, so enqueue, completion and lease handling
+    for different tasks rarely contend. Dequeue takes from whichever shard
+    has the highest-ranked head and steals from the others when that one
+    runs dry. Only parking and waking long-polls share a lock.
+
+    Tasks added with a run_at in the future wait in each shard's delayed
+    index until promote_scheduled() moves them onto the heap.
+
+    Tasks added with an idempotency key are enqueued once per key within
+    dedupe_ttl; adding the key again returns the first task's id.
+
+    dispatch picks the order tasks leave in: "strict" priority, optionally
+    with aging, or "fair" weighted fair queuing across priorities and named
+    queues; dispatch_options go to its constructor.
+    """
+
+    def __init__(
+        self,
+        persistence_file="tasks.json",
+        lease_timeout=60,
+        max_attempts=5,
+        shards=8,
+        metrics=None,
+        scheduler=DEFAULT_SCHEDULER,
+        dedupe_ttl=3600,
+        dedupe_max_keys=1000000,
+        dispatch=DEFAULT_DISPATCH,
+        dispatch_options=None,
+        **log_options,
+    ):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
         self.persistence_file = persistence_file
+        self.log = TaskLog(persistence_file, **log_options)
+        # Enqueue order across all shards; breaks ties within a priority.
+        self.sequence = itertools.count()
+        self.dispatch = get_dispatch(dispatch, **(dispatch_options or {}))
+        self.shards = [
+            TaskShard(
+                self.log,
+                self.sequence,
+                lease_timeout,
+                max_attempts,
+                metrics,
+                self.dispatch,
+            )
+            for _ in range(max(1, shards))
+        ]
+        # Parked get_task calls; the scheduler picks which one an incoming
+        # task goes to.
+        self.waiters = get_scheduler(scheduler)
+        self.waiters_lock = threading.Lock()
+        self.workers = WorkerRegistry()
+        self.dedupe = DedupeIndex(dedupe_ttl, dedupe_max_keys)
+        # Wakes promote_scheduled() when a delayed task is added, since it
+        # may be due before the one being waited for.
+        self._timer = threading.Condition()
+        self._timer_changed = False
+        self._compact_lock = threading.Lock()
+        self._compacting = False
         self.load_tasks()
 
-    def add_task(self, priority, task, timeout=300):
-        task_id = str(uuid.uuid4())
-        with self.lock:
-            heapq.heappush(self.tasks, PriorityTask(priority, task_id, task, timeout))
-            self.save_tasks()
-        return task_id
-
-    def get_task(self):
-        with self.lock:
-            while self.tasks:
-                task = heapq.heappop(self.tasks)
-                if time.time() - task.timestamp <= task.timeout:
-                    return task
-                print(f"task {task.task_id} timed out and has been discarded.")
-            return None
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def expired_count(self):
+        return sum(shard.expired_count for shard in self.shards)
+
+    @property
+    def scheduled_count(self):
+        return sum(len(shard.delayed) for shard in self.shards)
+
+    def depth_by_priority(self):
+        """Number of queued tasks at each priority."""
+        depth = {}
+        for shard in self.shards:
+            with shard.lock:
+                counts = list(shard.depth.items())
+            for priority, count in counts:
+                depth[priority] = depth.get(priority, 0) + count
+        return depth
+
+    def shard_for(self, task_id):
+        return self.shards[hash(task_id) % len(self.shards)]
+
+    def add_task(
+        self,
+        priority,
+        task,
+        timeout=300,
+        run_at=None,
+        idempotency_key=None,
+        queue=None,
+    ):
+        spec = (priority, task, timeout, run_at, idempotency_key, queue)
+        return self.add_tasks([spec])[0]
+
+    def add_tasks(self, specs):
+        """Enqueue (priority, task, timeout[, run_at[, idempotency_key[,
+        queue]]]) tuples with one log write per shard. A task with run_at is
+        held back until that time; one whose key was already seen is not
+        enqueued, and the earlier task's id is returned in its place."""
+        task_ids = []
+        queued = []
+        seq = 0
+        try:
+            for spec in specs:
+                spec = tuple(spec) + (None,) * (6 - len(spec))
+                task = PriorityTask(
+                    spec[0],
+                    str(uuid.uuid4()),
+                    spec[1],
+                    spec[2],
+                    run_at=spec[3],
+                    idempotency_key=spec[4],
+                    queue=spec[5],
+                )
+                if task.idempotency_key is not None:
+                    existing = self.dedupe.claim(task.idempotency_key, task.task_id)
+                    if existing is not None:
+                        task_ids.append(existing)
+                        continue
+                # Listed before ranking, so a key claimed for a task that
+                # fails to rank is released below too.
+                queued.append(task)
+                task.rank = self.dispatch.rank(task, next(self.sequence))
+                task_ids.append(task.task_id)
+            if not queued:
+                return task_ids
+            for shard, tasks in self._by_shard(queued, lambda task: task.task_id):
+                seq = max(seq, shard.enqueue(tasks))
+        except Exception:
+            for task in queued:
+                if task.idempotency_key is not None:
+                    self.dedupe.release(task.idempotency_key, task.task_id)
+            raise
+        if any(task.run_at is not None for task in queued):
+            self._reset_timer()
+        self._wake_waiters()
+        self._maybe_compact()
+        self.log.wait(seq)
+        return task_ids
+
+    def get_task(self, wait=0, owner=None):
+        """Pop the next task, blocking up to wait seconds if there is none."""
+        tasks = self.get_tasks(1, wait, owner)
+        return tasks[0] if tasks else None
+
+    def get_tasks(self, max_n, wait=0, owner=None):
+        """Pop up to max_n tasks, blocking up to wait seconds for the first."""
+        waiter = TaskWaiter(owner) if wait > 0 else None
+        tasks = self.get_tasks_or_park(max_n, waiter, owner)
+        if tasks or not waiter:
+            return tasks
+        waiter.event.wait(wait)
+        if self.cancel_wait(waiter):
+            return []
+        return [waiter.task]
+
+    def get_tasks_or_park(self, max_n, waiter=None, owner=None):
+        """Lease up to max_n tasks to owner, or park waiter if there are none."""
+        tasks = self._take(max_n, owner)
+        if tasks or waiter is None:
+            return tasks
+        # Look again under the waiters lock: an enqueue that landed after
+        # the first look either shows up here or finds the waiter parked.
+        with self.waiters_lock:
+            tasks = self._take(max_n, owner)
+            if not tasks:
+                self.waiters.add(waiter)
+        return tasks
+
+    def cancel_wait(self, waiter):
+        """Unpark waiter; returns False if a task was already delivered to it."""
+        with self.waiters_lock:
+            return self.waiters.remove(waiter)
+
+    def complete_task(self, task_id, owner=None):
+        lease = self.shard_for(task_id).complete(task_id, owner)
+        if lease is None:
+            return False
+        # Checked without the lock; a stale answer only skips one re-score.
+        if lease.owner is not None and self.waiters.is_parked(lease.owner):
+            with self.waiters_lock:
+                self.waiters.reschedule(lease.owner)
+        self._maybe_compact()
+        return True
+
+    def renew_leases(self, owner):
+        """Push back the deadline of every lease held by owner."""
+        deadline = time.time() + self.lease_timeout
+        for shard, task_ids in self._by_shard(list(owner.leases)):
+            shard.renew(task_ids, deadline)
+
+    def reclaim_expired_leases(self, limit=1000):
+        """Requeue or dead-letter up to limit expired leases.
+
+        Returns (requeued, dead_lettered).
+        """
+        requeued = dead_lettered = 0
+        for shard in self.shards:
+            remaining = limit - requeued - dead_lettered
+            if remaining <= 0:
+                break
+            shard_requeued, shard_dead_lettered = shard.reclaim(remaining)
+            requeued += shard_requeued
+            dead_lettered += shard_dead_lettered
+        if requeued:
+            self._wake_waiters()
+        return requeued, dead_lettered
+
+    def promote_scheduled(self, timeout=None):
+        """Sleep until the earliest delayed task is due, then queue every due one.
+
+        Returns early, after up to timeout seconds or when a task is added
+        with a run_at, having queued whatever was due by then. Returns the
+        number of tasks queued.
+        """
+        with self._timer:
+            if not self._timer_changed:
+                next_run_at = min(
+                    (
+                        run_at
+                        for run_at in (shard.next_run_at() for shard in self.shards)
+                        if run_at is not None
+                    ),
+                    default=None,
+                )
+                wait = timeout
+                if next_run_at is not None:
+                    wait = max(0.0, next_run_at - time.time())
+                    if timeout is not None:
+                        wait = min(wait, timeout)
+                if wait is None or wait > 0:
+                    self._timer.wait(wait)
+            self._timer_changed = False
+        now = time.time()
+        promoted = sum(shard.promote(now) for shard in self.shards)
+        if promoted:
+            self._wake_waiters()
+        return promoted
+
+    def _reset_timer(self):
+        with self._timer:
+            self._timer_changed = True
+            self._timer.notify_all()
+
+    def reap_expired(self, limit=1000):
+        """Drop up to limit queued tasks whose timeout has passed."""
+        reaped = 0
+        for shard in self.shards:
+            if reaped >= limit:
+                break
+            reaped += shard.reap(limit - reaped)
+        return reaped
 
     def add_worker(self, worker):
-        with self.lock:
-            self.workers.append(worker)
+        self.workers.add(worker)
 
     def remove_worker(self, worker):
-        with self.lock:
-            self.workers.remove(worker)
-
-    def get_free_worker(self):
-        with self.lock:
-            return (
-                min(self.workers, key=lambda worker_tasks: worker_tasks.task_count)
-                if self.workers
-                else None
-            )
+        """Unregister worker and hand its leased tasks to other workers."""
+        if not self.workers.remove(worker):
+            return
+        requeued = 0
+        for shard, task_ids in self._by_shard(list(worker.leases)):
+            requeued += shard.requeue_owned(task_ids, worker)
+        if requeued:
+            self._wake_waiters()
+
+    def dead_letters(self, limit=None):
+        """Records of up to limit dead-lettered tasks."""
+        records = []
+        for shard in self.shards:
+            records.extend(shard.dead_letter_records())
+            if limit is not None and len(records) >= limit:
+                return records[:limit]
+        return records
+
+    def retry_dead_letter(self, task_id):
+        """Queue a dead-lettered task again; returns False if there is none."""
+        if not self.shard_for(task_id).retry_dead_letter(task_id):
+            return False
+        self._wake_waiters()
+        return True
+
+    def _by_shard(self, items, key=None):
+        groups = {}
+        for item in items:
+            task_id = key(item) if key else item
+            groups.setdefault(hash(task_id) % len(self.shards), []).append(item)
+        return [(self.shards[index], group) for index, group in groups.items()]
+
+    def _take(self, max_n, owner):
+        # Merge the shard heaps: take from the shard with the best head until
+        # it drops below the runner-up's priority, then look again. Within
+        # one priority, FIFO order holds per shard rather than globally.
+        # Heads are read without locks, so a stale guess costs another pass.
+        tasks = []
+        while len(tasks) < max_n:
+            heads = []
+            for shard in self.shards:
+                head = shard.peek()
+                if head is not None:
+                    heads.append((head, shard))
+            if not heads:
+                break
+            heads.sort(key=lambda head: head[0])
+            max_level = heads[1][0] >> SEQ_BITS if len(heads) > 1 else None
+            tasks.extend(heads[0][1].take(max_n - len(tasks), owner, max_level))
+        self.dispatch.dequeued(tasks)
+        return tasks
+
+    def _wake_waiters(self):
+        with self.waiters_lock:
+            while self.waiters:
+                waiter = self.waiters.peek()
+                tasks = self._take(1, waiter.owner)
+                if not tasks:
+                    break
+                self.waiters.pop()
+                waiter.deliver(tasks[0])
+
+    def _maybe_compact(self):
+        if not self.log.needs_compaction():
+            return
+        with self._compact_lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        compactor = threading.Thread(target=self.save_tasks)
+        compactor.daemon = True
+        compactor.start()
 
     def save_tasks(self):
-        with open(self.persistence_file, "w") as f:
-            json.dump(
-                [
-                    {
-                        "priority": task.priority,
-                        "task_id": task.task_id,
-                        "task": task.task,
-                        "timestamp": task.timestamp,
-                        "timeout": task.timeout,
-                    }
-                    for task in self.tasks
-                ],
-                f,
+        """Write a snapshot of the queue and truncate the log behind it."""
+        try:
+            tasks = []
+            leased = []
+            dead_letters = []
+            with ExitStack() as locks:
+                for shard in self.shards:
+                    locks.enter_context(shard.lock)
+                for shard in self.shards:
+                    tasks.extend(shard.queued.values())
+                    tasks.extend(shard.delayed.values())
+                    leased.extend(lease.task for lease in shard.leases.values())
+                    dead_letters.extend(shard.dead_letters.values())
+                segment, seq = self.log.rotate()
+            self.log.write_snapshot(
+                {
+                    "tasks": [task.to_record() for task in tasks],
+                    "leased": [task.to_record() for task in leased],
+                    "dead_letters": [task.to_record() for task in dead_letters],
+                },
+                segment,
+                seq,
             )
+        except Exception as e:
+            print(f"Error compacting task log: {e}")
+        finally:
+            with self._compact_lock:
+                self._compacting = False
 
     def load_tasks(self):
-        if os.path.exists(self.persistence_file):
-            with open(self.persistence_file, "r") as f:
-                tasks_data = json.load(f)
-                for task_data in tasks_data:
-                    task = PriorityTask(
-                        task_data["priority"],
-                        task_data["task_id"],
-                        task_data["task"],
-                        task_data["timeout"],
-                    )
-                    task.timestamp = task_data["timestamp"]
-                    heapq.heappush(self.tasks, task)
+        state, records = self.log.replay()
+        pending = {
+            task_data["task_id"]: task_data for task_data in state.get("tasks", [])
+        }
+        dead = {
+            task_data["task_id"]: task_data
+            for task_data in state.get("dead_letters", [])
+        }
+        # Leases are kept apart so requeue and dead_letter records after the
+        # snapshot find them.
+        leased = {
+            task_data["task_id"]: task_data for task_data in state.get("leased", [])
+        }
+        for record in records:
+            op = record.pop("op")
+            task_id = record["task_id"]
+            if op == "enqueue":
+                dead.pop(task_id, None)
+                pending[task_id] = record
+            elif op == "dequeue":
+                task_data = pending.pop(task_id, None)
+                if task_data:
+                    task_data["attempts"] = task_data.get("attempts", 0) + 1
+                    leased[task_id] = task_data
+            elif op == "requeue":
+                task_data = leased.pop(task_id, None)
+                if task_data:
+                    pending[task_id] = task_data
+            elif op == "dead_letter":
+                task_data = leased.pop(task_id, None)
+                if task_data:
+                    dead[task_id] = task_data
+            else:
+                pending.pop(task_id, None)
+                leased.pop(task_id, None)
+
+        # Tasks leased out but never completed are delivered again.
+        pending.update(leased)
+        tasks = []
+        for task_data in sorted(
+            pending.values(), key=lambda task_data: task_data["timestamp"]
+        ):
+            try:
+                task = PriorityTask.from_record(task_data)
+                int(task.expires_at())
+                task.rank = self.dispatch.rank(task, next(self.sequence))
+            except (KeyError, OverflowError, TypeError, ValueError) as e:
+                # Dropped by the snapshot below rather than failing every
+                # restart.
+                print(f"Skipping unreadable task {task_data.get('task_id')}: {e}")
+                continue
+            tasks.append(task)
+        for shard, shard_tasks in self._by_shard(tasks, lambda task: task.task_id):
+            shard._push_many(shard_tasks)
+        # Keys of tasks still queued are remembered across restarts; those
+        # of completed tasks are only in memory.
+        for task in tasks:
+            if task.idempotency_key is not None:
+                self.dedupe.restore(task.idempotency_key, task.task_id, task.timestamp)
+        for task_id, task_data in dead.items():
+            self.shard_for(task_id).dead_letters[task_id] = PriorityTask.from_record(
+                task_data
+            )
+        self.save_tasks()
+
+    def close(self):
+        self._reset_timer()
+        self.log.close()
@@ -0,0 +1,320 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from .lease import Lease
+from .dispatch import StrictPriority
+from .priority_task import SEQ_BITS
+
+
+class TaskShard:
+    """One priority heap behind its own lock, plus the leases of its tasks.
+
+    A task stays on the shard it was enqueued to for its whole life, so any
+    operation on a single task locks only that shard. Every change is logged
+    while the shard lock is held, which keeps the log in step with the
+    snapshot TaskQueue takes under all shard locks.
+
+    The heap holds bare int ranks (see make_rank), assigned by the queue's
+    dispatch policy (see definitions.dispatch); the tasks themselves,
+    payload included, live in queued under the same rank. Tasks with a
+    run_at still ahead wait in delayed, ordered by a heap of (run_at,
+    task_id), and join the priority heap when promote() finds them due.
+    """
+
+    def __init__(
+        self,
+        log,
+        sequence,
+        lease_timeout=60,
+        max_attempts=5,
+        metrics=None,
+        dispatch=None,
+    ):
+        self.log = log
+        self.sequence = sequence
+        self.dispatch = dispatch or StrictPriority()
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.tasks = []
+        # Live queued tasks by rank. Heap entries missing from here are
+        # tombstones left by the expiry reaper and are skipped on pop.
+        self.queued = {}
+        self.tombstones = 0
+        # Queued task counts by priority.
+        self.depth = {}
+        # Ranks of queued tasks bucketed by the whole second they expire
+        # in, plus a heap of those seconds, so expired tasks are found
+        # without scanning the priority heap.
+        self.expiry = {}
+        self.expiry_seconds = []
+        self.expired_count = 0
+        self.delayed = {}
+        self.delayed_run_at = []
+        self.leases = {}
+        # (deadline, task_id) entries; renewals push a new entry and leave
+        # the old one behind to be skipped when it surfaces.
+        self.lease_deadlines = []
+        self.dead_letters = OrderedDict()
+        self.lock = threading.Lock()
+        self.time_in_queue = None
+        self.time_leased = None
+        if metrics is not None:
+            self.time_in_queue = metrics.histogram("time_in_queue_seconds")
+            self.time_leased = metrics.histogram("dispatch_to_completion_seconds")
+
+    def __len__(self):
+        return len(self.queued)
+
+    def next_run_at(self):
+        """Earliest delayed run_at, read without the lock; None if none."""
+        try:
+            return self.delayed_run_at[0][0]
+        except IndexError:
+            return None
+
+    def peek(self):
+        """Head of the heap, read without the lock; may be stale or a tombstone."""
+        try:
+            return self.tasks[0]
+        except IndexError:
+            return None
+
+    def enqueue(self, tasks):
+        # A timeout or run_at that is not a finite number fails here, before
+        # the task is logged, rather than in _push_many or on every replay.
+        for task in tasks:
+            int(task.expires_at())
+        with self.lock:
+            seq = self.log.append_many("enqueue", [task.to_record() for task in tasks])
+            self._push_many(tasks)
+        return seq
+
+    def take(self, max_n, owner=None, max_level=None):
+        """Lease up to max_n tasks to owner, stopping at ranks above max_level.
+
+        A rank's level is rank >> SEQ_BITS; lower levels go first.
+        """
+        tasks = []
+        expired = []
+        with self.lock:
+            now = time.time()
+            while self.tasks and len(tasks) < max_n:
+                if max_level is not None and self.tasks[0] >> SEQ_BITS > max_level:
+                    break
+                task = self.queued.pop(heapq.heappop(self.tasks), None)
+                if task is None:
+                    self.tombstones -= 1
+                    continue
+                self._count(task, -1)
+                if now <= task.expires_at():
+                    self._lease(task, owner, now)
+                    tasks.append(task)
+                else:
+                    expired.append(task.task_id)
+            self._discard_expired(expired)
+            if tasks:
+                self.log.append_many(
+                    "dequeue", [{"task_id": task.task_id} for task in tasks]
+                )
+        if self.time_in_queue is not None:
+            for task in tasks:
+                self.time_in_queue.observe(now - task.ready_at())
+        return tasks
+
+    def complete(self, task_id, owner=None):
+        """Release task_id's lease; returns the Lease, or None if it had none.
+
+        With owner, only a lease owner holds is released: a completion from
+        a worker whose lease expired and was handed on is stale.
+        """
+        with self.lock:
+            lease = self.leases.get(task_id)
+            if lease is None or owner is not None and lease.owner is not owner:
+                return None
+            self._release(task_id)
+            self.log.append("complete", task_id=task_id)
+        elapsed = time.time() - lease.leased_at
+        if lease.owner is not None:
+            lease.owner.record_service_time(elapsed)
+        if self.time_leased is not None:
+            self.time_leased.observe(elapsed)
+        return lease
+
+    def promote(self, now):
+        """Move delayed tasks whose run_at has passed onto the priority heap.
+
+        They rank behind tasks already queued at their priority, as if
+        enqueued now. Returns the number moved.
+        """
+        due = []
+        with self.lock:
+            while self.delayed_run_at and self.delayed_run_at[0][0] <= now:
+                _, task_id = heapq.heappop(self.delayed_run_at)
+                task = self.delayed.pop(task_id)
+                task.rank = self.dispatch.rank(task, next(self.sequence))
+                due.append(task)
+            if due:
+                self._push_many(due)
+        return len(due)
+
+    def renew(self, task_ids, deadline):
+        with self.lock:
+            for task_id in task_ids:
+                lease = self.leases.get(task_id)
+                if lease is None:
+                    continue
+                lease.deadline = deadline
+                heapq.heappush(self.lease_deadlines, (deadline, task_id))
+
+    def requeue_owned(self, task_ids, owner):
+        """Requeue the given leases if owner still holds them; returns how many."""
+        requeued = 0
+        with self.lock:
+            for task_id in task_ids:
+                lease = self.leases.get(task_id)
+                if lease is not None and lease.owner is owner:
+                    requeued += self._requeue(task_id)
+        return requeued
+
+    def reclaim(self, limit):
+        """Requeue or dead-letter up to limit expired leases.
+
+        Returns (requeued, dead_lettered).
+        """
+        requeued = dead_lettered = 0
+        with self.lock:
+            now = time.time()
+            while self.lease_deadlines and requeued + dead_lettered < limit:
+                deadline, task_id = self.lease_deadlines[0]
+                if deadline > now:
+                    break
+                heapq.heappop(self.lease_deadlines)
+                lease = self.leases.get(task_id)
+                if lease is None or lease.deadline != deadline:
+                    continue
+                if self._requeue(task_id):
+                    requeued += 1
+                else:
+                    dead_lettered += 1
+        return requeued, dead_lettered
+
+    def reap(self, limit):
+        """Drop up to limit queued tasks whose timeout has passed.
+
+        Their heap entries stay behind as tombstones until popped, or until
+        they make up half the heap and it is rebuilt. Returns the number of
+        tasks dropped.
+        """
+        expired = []
+        with self.lock:
+            # Only whole seconds that are over, so every task in the bucket
+            # has expired; dequeue catches the rest of the current second.
+            current = int(time.time())
+            while self.expiry_seconds and len(expired) < limit:
+                second = self.expiry_seconds[0]
+                if second >= current:
+                    break
+                bucket = self.expiry[second]
+                while bucket and len(expired) < limit:
+                    task = self.queued.pop(bucket.pop(), None)
+                    if task is not None:
+                        self._count(task, -1)
+                        self.tombstones += 1
+                        expired.append(task.task_id)
+                if not bucket:
+                    heapq.heappop(self.expiry_seconds)
+                    del self.expiry[second]
+            self._discard_expired(expired)
+            if self.tombstones > 1024 and self.tombstones * 2 > len(self.tasks):
+                self.tasks = list(self.queued)
+                heapq.heapify(self.tasks)
+                self.tombstones = 0
+        return len(expired)
+
+    def dead_letter_records(self):
+        with self.lock:
+            return [task.to_record() for task in self.dead_letters.values()]
+
+    def retry_dead_letter(self, task_id):
+        with self.lock:
+            task = self.dead_letters.pop(task_id, None)
+            if task is None:
+                return False
+            task.attempts = 0
+            task.timestamp = time.time()
+            task.run_at = None
+            task.rank = self.dispatch.rank(task, next(self.sequence))
+            self.log.append("enqueue", **task.to_record())
+            self._push_many([task])
+        return True
+
+    def _push_many(self, tasks):
+        now = time.time()
+        ranks = []
+        for task in tasks:
+            if task.run_at is not None and task.run_at > now:
+                self.delayed[task.task_id] = task
+                heapq.heappush(self.delayed_run_at, (task.run_at, task.task_id))
+                continue
+            second = int(task.expires_at())
+            self.queued[task.rank] = task
+            self._count(task, 1)
+            ranks.append(task.rank)
+            bucket = self.expiry.get(second)
+            if bucket is None:
+                bucket = self.expiry[second] = []
+                heapq.heappush(self.expiry_seconds, second)
+            bucket.append(task.rank)
+        # Merging with heapify beats repeated heappush once the batch is
+        # larger than the heap it joins.
+        if len(ranks) > len(self.tasks):
+            self.tasks.extend(ranks)
+            heapq.heapify(self.tasks)
+        else:
+            for rank in ranks:
+                heapq.heappush(self.tasks, rank)
+
+    def _count(self, task, n):
+        count = self.depth.get(task.priority, 0) + n
+        if count:
+            self.depth[task.priority] = count
+        else:
+            del self.depth[task.priority]
+
+    def _discard_expired(self, task_ids):
+        if not task_ids:
+            return
+        self.log.append_many("discard", [{"task_id": task_id} for task_id in task_ids])
+        self.expired_count += len(task_ids)
+        print(f"{len(task_ids)} tasks timed out and have been discarded.")
+
+    def _lease(self, task, owner, now):
+        deadline = now + self.lease_timeout
+        task.attempts += 1
+        self.leases[task.task_id] = Lease(task, owner, deadline, now)
+        heapq.heappush(self.lease_deadlines, (deadline, task.task_id))
+        if owner is not None:
+            owner.leases.add(task.task_id)
+            owner.increment_task_count()
+
+    def _release(self, task_id):
+        lease = self.leases.pop(task_id, None)
+        if lease is None:
+            return None
+        if lease.owner is not None:
+            lease.owner.leases.discard(task_id)
+            lease.owner.decrement_task_count()
+        return lease
+
+    def _requeue(self, task_id):
+        """Put a leased task back on the heap; returns False if it was dead-lettered."""
+        task = self._release(task_id).task
+        if task.attempts >= self.max_attempts:
+            self.dead_letters[task_id] = task
+            self.log.append("dead_letter", task_id=task_id)
+            print(f"task {task_id} failed {task.attempts} times, moved to dead letters")
+            return False
+        self.log.append("requeue", task_id=task_id)
+        self._push_many([task])
+        return True
@@ -1,3 +1,4 @@
+import threading
 import time
 
 
@@ -6,13 +7,38 @@ class Worker:
         self.socket = socket
         self.address = address
         self.task_count = 0
+        self.capacity = None
+        # EWMA of dispatch-to-completion seconds, None until one completes.
+        self.service_time = None
+        self.leases = set()
         self.last_heartbeat = time.time()
+        # Set while a long-poll is parked; the worker is silent but waiting
+        # on us, so it counts as heard from.
+        self.parked = False
+        # Leases on different queue shards update the count concurrently.
+        self._count_lock = threading.Lock()
 
     def increment_task_count(self):
-        self.task_count += 1
+        with self._count_lock:
+            self.task_count += 1
 
     def decrement_task_count(self):
-        self.task_count = max(0, self.task_count - 1)
+        with self._count_lock:
+            self.task_count = max(0, self.task_count - 1)
+
+    def record_service_time(self, seconds, alpha=0.2):
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += alpha * (seconds - self.service_time)
+
+    def has_credit(self):
+        return self.capacity is None or self.task_count < self.capacity
+
+    def available_credit(self, requested):
+        if self.capacity is None:
+            return requested
+        return max(0, min(requested, self.capacity - self.task_count))
 
     def update_heartbeat(self):
         self.last_heartbeat = time.time()
@@ -0,0 +1,72 @@
+import heapq
+import itertools
+import threading
+
+
+class WorkerRegistry:
+    """Connected workers, kept apart from the task shards.
+
+    Adding and removing a worker is a single dict operation, atomic under the
+    GIL, so the heartbeat sweep can walk a snapshot without taking any lock
+    that enqueue or dequeue need.
+
+    Liveness is tracked with a heap of (deadline, seq, worker) entries, one
+    live entry per worker. Traffic only moves worker.last_heartbeat; an entry
+    that comes due for a worker heard from since is pushed back then, so the
+    sweep touches only the workers whose deadline has passed.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.deadlines = []
+        self.entries = {}
+        self._order = itertools.count()
+        self._deadlines_lock = threading.Lock()
+
+    def add(self, worker):
+        self.workers[id(worker)] = worker
+        with self._deadlines_lock:
+            self._schedule(worker, worker.last_heartbeat)
+
+    def remove(self, worker):
+        """Returns False if worker was already removed."""
+        return self.workers.pop(id(worker), None) is not None
+
+    def sweep(self, now, timeout):
+        """Pop every worker whose deadline has passed.
+
+        Returns (expired, alive): workers not heard from in timeout seconds,
+        and workers heard from since their entry was pushed, which are
+        rescheduled. Removed workers' entries are dropped on the way.
+        """
+        expired, alive = [], []
+        with self._deadlines_lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, seq, worker = heapq.heappop(self.deadlines)
+                if self.entries.get(id(worker)) != seq:
+                    continue
+                if worker.parked:
+                    worker.last_heartbeat = now
+                if id(worker) not in self.workers:
+                    del self.entries[id(worker)]
+                elif worker.last_heartbeat + timeout <= now:
+                    del self.entries[id(worker)]
+                    expired.append(worker)
+                else:
+                    self._schedule(worker, worker.last_heartbeat + timeout)
+                    alive.append(worker)
+        return expired, alive
+
+    def _schedule(self, worker, deadline):
+        seq = next(self._order)
+        self.entries[id(worker)] = seq
+        heapq.heappush(self.deadlines, (deadline, seq, worker))
+
+    def snapshot(self):
+        return list(self.workers.values())
+
+    def __contains__(self, worker):
+        return id(worker) in self.workers
+
+    def __len__(self):
+        return len(self.workers)
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+
+def resident_memory():
+    """Resident set size of this process in bytes, or None where unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class TokenBucket:
+    """rate tokens a second, holding at most burst."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n, now):
+        """Spend n tokens; returns 0, or the seconds until they will be there."""
+        self.refill(now)
+        # A batch larger than the bucket goes in once it is full, leaving
+        # the bucket in debt, rather than never.
+        need = min(n, self.burst)
+        if self.tokens < need:
+            return (need - self.tokens) / self.rate
+        self.tokens -= n
+        return 0
+
+
+class Admission:
+    """Whether an enqueue is let in, and if not, when to retry it.
+
+    Queue depth and memory are sampled by a monitor through update(); tasks
+    admitted since the last sample are counted on top, so a burst between
+    samples cannot push the queue past max_queue_depth. Each client host
+    also gets a token bucket of client_rate tasks a second, holding up to
+    client_burst. Limits left as None are not enforced.
+    """
+
+    def __init__(
+        self,
+        max_queue_depth=None,
+        max_memory=None,
+        client_rate=None,
+        client_burst=None,
+        retry_after=1.0,
+    ):
+        self.max_queue_depth = max_queue_depth
+        self.max_memory = max_memory
+        self.client_rate = client_rate
+        self.client_burst = client_burst or client_rate
+        self.retry_after = retry_after
+        self.depth = 0
+        self.memory = None
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def watches_load(self):
+        return bool(self.max_queue_depth or self.max_memory)
+
+    def update(self, depth, memory):
+        with self._lock:
+            self.depth = depth
+            self.memory = memory
+
+    def admit(self, client, n, now=None):
+        """None if n tasks from client may be enqueued, else (reason, retry_after)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.max_queue_depth and self.depth + n > self.max_queue_depth:
+                return "queue_depth", self.retry_after
+            if (
+                self.max_memory
+                and self.memory is not None
+                and self.memory >= self.max_memory
+            ):
+                return "memory", self.retry_after
+            if self.client_rate:
+                bucket = self.buckets.get(client)
+                if bucket is None:
+                    if len(self.buckets) >= 4096:
+                        self._prune(now)
+                    bucket = TokenBucket(self.client_rate, self.client_burst, now)
+                    self.buckets[client] = bucket
+                wait = bucket.take(n, now)
+                if wait:
+                    return "rate", wait
+            self.depth += n
+        return None
+
+    def _prune(self, now):
+        # A bucket that has refilled is no different from a new one.
+        for client, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[client]
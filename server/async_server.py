@@ -0,0 +1,269 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from definitions.result_store import ResultWaiter
+from definitions.task_queue import TaskWaiter
+from server.task_server import POLL_TYPES, TaskQueueServer
+from shared.framing import encode_frame, read_frame_async
+
+
+class AsyncTaskWaiter(TaskWaiter):
+    """TaskWaiter that resolves a future on the event loop instead of blocking."""
+
+    def __init__(self, loop, owner=None):
+        super().__init__(owner)
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def deliver(self, task):
+        super().deliver(task)
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AsyncResultWaiter(ResultWaiter):
+    """ResultWaiter that resolves a future on the event loop instead of blocking."""
+
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def deliver(self, result):
+        super().deliver(result)
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AsyncTaskQueueServer(TaskQueueServer):
+    """TaskQueueServer that serves every connection from one event loop.
+
+    Sockets are owned by the loop. Decryption, HMAC checks, response
+    encoding and every queue and result store call, which with a
+    queue_backend is a round trip to the owner process, run in a small
+    thread pool; the loop only does I/O, waits on parked polls and encrypts
+    session frames in order.
+    """
+
+    def __init__(self, *args, executor_workers=None, backlog=4096, **kwargs):
+        super().__init__(*args, **kwargs)
+        if executor_workers is None:
+            # With a queue_backend most calls wait on the owner rather than
+            # the CPU, so more of them need to be in flight at once.
+            executor_workers = 64 if self.queue_backend else None
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers or min(32, (os.cpu_count() or 1) + 4),
+            thread_name_prefix="crypto",
+        )
+        self.backlog = backlog
+        self.loop = None
+        self.server = None
+        self.connections = set()
+
+    async def in_executor(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def in_background(self, func, *args):
+        """Run cleanup in the pool without waiting for it."""
+        try:
+            self.executor.submit(func, *args)
+        except RuntimeError:
+            # The pool is shut down; the server is going away anyway.
+            func(*args)
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+        )
+        print(f"async server is listening on {self.host}:{self.port}")
+        self.start_monitors()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        connection = asyncio.current_task()
+        self.connections.add(connection)
+        worker = None
+        # Every get_task parked on this connection, so none outlives it.
+        waiters = set()
+        session = None
+        first_frame = True
+        try:
+            while True:
+                encrypted = await read_frame_async(reader, self.max_frame_size)
+                if not encrypted:
+                    print(f"Client {address} disconnected")
+                    break
+                started = time.perf_counter()
+                if worker:
+                    worker.update_heartbeat()
+
+                if first_frame:
+                    first_frame = False
+                    hello, session = self.accept_hello(encrypted)
+                    if hello:
+                        writer.write(encode_frame(hello, self.max_frame_size))
+                        await writer.drain()
+                        continue
+
+                data, payload, worker, poll = await self.in_executor(
+                    self.process_frame, encrypted, address, session, worker, writer
+                )
+                waiter = None
+                if isinstance(poll, AsyncTaskWaiter):
+                    # Parked workers wait on a future, not an executor thread,
+                    # and the connection keeps reading while they do.
+                    waiter = poll
+                    waiters.add(waiter)
+                    poll = self.finish_poll(
+                        waiter, worker, data, writer, session, started
+                    )
+                elif poll is not None:
+                    poll = self.finish_result_poll(poll, data, writer, session, started)
+                if poll is not None:
+                    poll = asyncio.create_task(poll)
+                    self.connections.add(poll)
+                    poll.add_done_callback(self.connections.discard)
+                    if waiter:
+                        poll.add_done_callback(
+                            lambda _, waiter=waiter: waiters.discard(waiter)
+                        )
+                    continue
+                await self.send(writer, payload, data, session, started)
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print(f"Socket error with {address}: {e}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+        finally:
+            self.connections.discard(connection)
+            for waiter in waiters:
+                self.in_background(self.task_queue.cancel_wait, waiter)
+            if worker:
+                print(f"Removing worker {address}")
+                self.in_background(self.unregister_worker, worker)
+            writer.close()
+
+    def process_frame(self, encrypted, address, session, worker, writer):
+        """Everything for one frame that may block, run as one pool job.
+
+        Returns (data, payload, worker, waiter): the encoded reply, or for a
+        long-poll that was parked no payload and the waiter to finish it with.
+        """
+        data, response = self.decode_frame(encrypted, address, session)
+        if response is None and data["type"] in POLL_TYPES:
+            worker = self.register_worker(worker, writer, address, data)
+            response, waiter = self.poll_task(
+                worker, data, AsyncTaskWaiter(self.loop, worker)
+            )
+            if waiter:
+                return data, None, worker, waiter
+        elif response is None and data["type"] == "wait_result":
+            response, waiter = self.poll_result(data, AsyncResultWaiter(self.loop))
+            if waiter:
+                return data, None, worker, waiter
+        elif response is None:
+            response, worker = self.handle_message(data, worker, writer, address)
+        return data, self.encode_response(response, data, session), worker, None
+
+    async def respond(self, writer, response, data, session=None, started=None):
+        payload = await self.in_executor(self.encode_response, response, data, session)
+        await self.send(writer, payload, data, session, started)
+
+    async def send(self, writer, payload, data, session=None, started=None):
+        # Encrypt on the loop, right before the write, so session nonces go
+        # out in order even when several responses were encoded at once.
+        if session:
+            with self.metrics.timer("crypto_seconds", "encrypt"):
+                payload = session.encrypt(payload)
+        writer.write(encode_frame(payload, self.max_frame_size))
+        await writer.drain()
+        if started is not None:
+            self.record_request(data, started)
+
+    async def finish_poll(
+        self, waiter, worker, data, writer, session=None, started=None
+    ):
+        try:
+            await asyncio.wait_for(waiter.future, self.poll_wait(data))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self.in_background(self.task_queue.cancel_wait, waiter)
+            raise
+        worker.parked = False
+        worker.update_heartbeat()
+        cancelled = await self.in_executor(self.task_queue.cancel_wait, waiter)
+        tasks = [] if cancelled else [waiter.task]
+        try:
+            await self.respond(
+                writer, self.task_response(worker, tasks, data), data, session, started
+            )
+        except Exception as e:
+            print(f"Error sending task to {worker.address}: {e}")
+
+    async def finish_result_poll(
+        self, waiter, data, writer, session=None, started=None
+    ):
+        try:
+            await asyncio.wait_for(waiter.future, self.poll_wait(data))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self.in_background(self.results.cancel_wait, data["task_id"], waiter)
+            raise
+        if await self.in_executor(self.results.cancel_wait, data["task_id"], waiter):
+            response = {"status": "pending"}
+        else:
+            response = {"status": "ok", "result": waiter.result}
+        try:
+            await self.respond(writer, response, data, session, started)
+        except Exception as e:
+            print(f"Error sending result for {data['task_id']}: {e}")
+
+    def disconnect_worker(self, worker):
+        # worker.socket is the connection's StreamWriter here.
+        try:
+            self.loop.call_soon_threadsafe(worker.socket.close)
+        except RuntimeError:
+            pass
+
+    def shutdown(self):
+        print("Shutting down server...")
+        self.running = False
+        if self.loop and self.server and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.server.close)
+                for task in list(self.connections):
+                    self.loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass
+        self.executor.shutdown(wait=False)
+        try:
+            self.sock.close()
+        except:
+            pass
+        self.task_queue.close()
+        print("Server shutdown complete")
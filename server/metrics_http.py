@@ -0,0 +1,38 @@
+import threading
+
+try:
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import PlainTextResponse
+except ImportError:  # optional; the server runs without its metrics endpoint
+    uvicorn = None
+
+
+def create_app(metrics):
+    app = FastAPI(title="task queue metrics")
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def prometheus():
+        return metrics.render_prometheus()
+
+    @app.get("/metrics.json")
+    def snapshot():
+        return metrics.snapshot()
+
+    return app
+
+
+def serve_metrics(metrics, host="127.0.0.1", port=9100):
+    """Serve metrics over HTTP from a daemon thread; returns the uvicorn server."""
+    if uvicorn is None:
+        print("fastapi/uvicorn not installed, metrics endpoint disabled")
+        return None
+    config = uvicorn.Config(
+        create_app(metrics), host=host, port=port, log_level="warning"
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    print(f"metrics available on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,620 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from definitions.dispatch import DEFAULT_DISPATCH
+from definitions.priority_task import PriorityTask
+from definitions.result_store import ResultStore, ResultWaiter
+from definitions.scheduler import DEFAULT_SCHEDULER
+from definitions.task_queue import TaskQueue, TaskWaiter
+from definitions.worker import Worker
+from definitions.worker_registry import WorkerRegistry
+from server.admission import resident_memory
+from server.metrics_http import serve_metrics
+from shared.codec import DEFAULT_CODEC, get_codec
+from shared.framing import DEFAULT_MAX_FRAME_SIZE, FrameReader, send_frame
+from shared.metrics import Metrics
+
+# Shared queue backend for multi-process servers. One owner process holds
+# the TaskQueue and ResultStore; front-end server processes, each accepting
+# on the same port with SO_REUSEPORT, do the crypto and forward queue
+# operations over a Unix socket. Parked polls stay parked in the owner and
+# are pushed back to the front-end that parked them.
+
+
+class RemoteTaskWaiter(TaskWaiter):
+    """Owner-side stand-in for a get_task parked in a front-end process."""
+
+    def __init__(self, channel, waiter_id, owner=None):
+        super().__init__(owner)
+        self.channel = channel
+        self.waiter_id = waiter_id
+
+    def deliver(self, task):
+        super().deliver(task)
+        self.channel.push(
+            {
+                "op": "task",
+                "waiter": self.waiter_id,
+                "task": task.to_record(),
+                "worker": self.owner.address if self.owner else None,
+                "task_count": self.owner.task_count if self.owner else 0,
+            }
+        )
+
+
+class RemoteResultWaiter(ResultWaiter):
+    """Owner-side stand-in for a wait_result parked in a front-end process."""
+
+    def __init__(self, channel, waiter_id):
+        super().__init__()
+        self.channel = channel
+        self.waiter_id = waiter_id
+
+    def deliver(self, result):
+        super().deliver(result)
+        self.channel.push({"op": "result", "waiter": self.waiter_id, "result": result})
+
+
+class OwnerChannel:
+    """The owner's end of one front-end connection.
+
+    Requests run on the owner's thread pool, since add_tasks waits for the
+    log, and every reply or push goes through one outbox so a delivery made
+    under a queue lock never blocks on the socket.
+    """
+
+    def __init__(self, owner, sock):
+        self.owner = owner
+        self.sock = sock
+        self.codec = get_codec(DEFAULT_CODEC)
+        self.outbox = queue.SimpleQueue()
+        self.workers = {}
+        self.task_waiters = {}
+        self.result_waiters = {}
+
+    def start(self):
+        for target in (self.read_loop, self.write_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def push(self, message):
+        self.outbox.put(message)
+
+    def write_loop(self):
+        try:
+            while True:
+                message = self.outbox.get()
+                if message is None:
+                    break
+                send_frame(
+                    self.sock, self.codec.encode(message), self.owner.max_frame_size
+                )
+        except OSError as e:
+            print(f"Queue owner send error: {e}")
+
+    def read_loop(self):
+        reader = FrameReader(self.sock, self.owner.max_frame_size)
+        try:
+            while True:
+                frame = reader.read_frame()
+                if not frame:
+                    break
+                self.owner.executor.submit(self.handle, self.codec.decode(frame))
+        except Exception as e:
+            print(f"Queue owner connection error: {e}")
+        finally:
+            self.close()
+
+    def handle(self, request):
+        try:
+            handler = getattr(self, f"op_{request['op']}")
+            self.push({"id": request["id"], "result": handler(**request["args"])})
+        except Exception as e:
+            self.push({"id": request["id"], "error": str(e)})
+
+    def close(self):
+        for waiter in list(self.task_waiters.values()):
+            self.owner.queue.cancel_wait(waiter)
+        for task_id, waiter in list(self.result_waiters.values()):
+            self.owner.results.cancel_wait(task_id, waiter)
+        for worker in list(self.workers.values()):
+            self.owner.queue.remove_worker(worker)
+        self.push(None)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def op_add_tasks(self, specs):
+        return self.owner.queue.add_tasks([tuple(spec) for spec in specs])
+
+    def op_add_worker(self, worker):
+        self.workers[worker] = Worker(None, worker)
+        self.owner.queue.add_worker(self.workers[worker])
+
+    def op_remove_worker(self, worker):
+        record = self.workers.pop(worker, None)
+        if record:
+            self.owner.queue.remove_worker(record)
+
+    def op_take(self, max_n, worker, waiter=None, capacity=None):
+        record = self.workers.get(worker)
+        if record is not None:
+            record.capacity = capacity
+        remote_waiter = None
+        if waiter is not None:
+            remote_waiter = RemoteTaskWaiter(self, waiter, record)
+            self.task_waiters[waiter] = remote_waiter
+        tasks = self.owner.queue.get_tasks_or_park(max_n, remote_waiter, record)
+        if tasks:
+            self.task_waiters.pop(waiter, None)
+        return {
+            "tasks": [task.to_record() for task in tasks],
+            "parked": remote_waiter is not None and not tasks,
+            "task_count": record.task_count if record else 0,
+        }
+
+    def op_cancel_wait(self, waiter):
+        remote_waiter = self.task_waiters.pop(waiter, None)
+        return remote_waiter is not None and self.owner.queue.cancel_wait(remote_waiter)
+
+    def op_complete(self, task_id, worker=None):
+        lease = self.owner.queue.shard_for(task_id).leases.get(task_id)
+        holder = lease.owner if lease else None
+        record = self.workers.get(worker)
+        # A worker this front-end no longer has holds no leases.
+        completed = (worker is None or record is not None) and (
+            self.owner.queue.complete_task(task_id, record)
+        )
+        return {
+            "completed": completed,
+            "worker": holder.address if holder else None,
+            "task_count": holder.task_count if holder else 0,
+        }
+
+    def op_dead_letters(self, limit=None):
+        return self.owner.queue.dead_letters(limit)
+
+    def op_retry_dead_letter(self, task_id):
+        return self.owner.queue.retry_dead_letter(task_id)
+
+    def op_renew(self, worker):
+        record = self.workers.get(worker)
+        if record is None:
+            return 0
+        self.owner.queue.renew_leases(record)
+        return record.task_count
+
+    def op_load(self):
+        queue = self.owner.queue
+        return [len(queue) + queue.scheduled_count, resident_memory()]
+
+    def op_result_put(self, task_id, result):
+        self.owner.results.put(task_id, result)
+
+    def op_result_get(self, task_id):
+        return self.owner.results.get(task_id)
+
+    def op_result_park(self, task_id, waiter):
+        remote_waiter = RemoteResultWaiter(self, waiter)
+        self.result_waiters[waiter] = (task_id, remote_waiter)
+        found, result = self.owner.results.get_or_park(task_id, remote_waiter)
+        if found:
+            self.result_waiters.pop(waiter, None)
+        return found, result
+
+    def op_result_cancel(self, task_id, waiter):
+        _, remote_waiter = self.result_waiters.pop(waiter, (None, None))
+        return remote_waiter is not None and self.owner.results.cancel_wait(
+            task_id, remote_waiter
+        )
+
+    def op_result_count(self):
+        return len(self.owner.results)
+
+
+class QueueOwner:
+    """Process that owns the queue, its log and the result store."""
+
+    def __init__(
+        self,
+        socket_path,
+        lease_timeout=60,
+        max_attempts=5,
+        queue_shards=8,
+        scheduler=DEFAULT_SCHEDULER,
+        dedupe_ttl=3600,
+        dedupe_max_keys=1000000,
+        dispatch=DEFAULT_DISPATCH,
+        dispatch_options=None,
+        lease_check_interval=1,
+        expiry_check_interval=1,
+        result_ttl=3600,
+        result_max_bytes=64 * 1024 * 1024,
+        result_spill_dir=None,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        metrics_host="127.0.0.1",
+        metrics_port=None,
+    ):
+        self.socket_path = socket_path
+        self.lease_check_interval = lease_check_interval
+        self.expiry_check_interval = expiry_check_interval
+        self.max_frame_size = max_frame_size
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics = Metrics()
+        self.queue = TaskQueue(
+            lease_timeout=lease_timeout,
+            max_attempts=max_attempts,
+            shards=queue_shards,
+            scheduler=scheduler,
+            metrics=self.metrics,
+            dedupe_ttl=dedupe_ttl,
+            dedupe_max_keys=dedupe_max_keys,
+            dispatch=dispatch,
+            dispatch_options=dispatch_options,
+        )
+        self.results = ResultStore(
+            ttl=result_ttl, max_bytes=result_max_bytes, spill_dir=result_spill_dir
+        )
+        self.metrics.gauge("queue_depth", self.queue.depth_by_priority)
+        self.metrics.gauge("tasks_expired", lambda: {None: self.queue.expired_count})
+        self.metrics.gauge(
+            "tasks_scheduled", lambda: {None: self.queue.scheduled_count}
+        )
+        self.metrics.gauge("tasks_deduplicated", lambda: {None: self.queue.dedupe.hits})
+        self.metrics.gauge("results_stored", lambda: {None: len(self.results)})
+        self.executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="owner")
+        self.running = True
+
+    def check_leases(self):
+        while self.running:
+            try:
+                requeued, dead_lettered = self.queue.reclaim_expired_leases()
+                if requeued or dead_lettered:
+                    self.metrics.inc("tasks_requeued", requeued)
+                    self.metrics.inc("tasks_dead_lettered", dead_lettered)
+                else:
+                    time.sleep(self.lease_check_interval)
+            except Exception as e:
+                print(f"Error in lease checker: {e}")
+
+    def reap_expired_tasks(self):
+        while self.running:
+            try:
+                if not self.queue.reap_expired():
+                    time.sleep(self.expiry_check_interval)
+            except Exception as e:
+                print(f"Error in expiry reaper: {e}")
+
+    def promote_scheduled_tasks(self):
+        while self.running:
+            try:
+                self.metrics.inc("tasks_promoted", self.queue.promote_scheduled())
+            except Exception as e:
+                print(f"Error in task scheduler: {e}")
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(64)
+        for target in (
+            self.check_leases,
+            self.reap_expired_tasks,
+            self.promote_scheduled_tasks,
+        ):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        if self.metrics_port is not None:
+            serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+        print(f"queue owner is listening on {self.socket_path}")
+        try:
+            while self.running:
+                connection, _ = sock.accept()
+                OwnerChannel(self, connection).start()
+        finally:
+            self.running = False
+            sock.close()
+            self.queue.close()
+
+
+class QueueBackend:
+    """A front-end process's connection to the queue owner."""
+
+    def __init__(self, socket_path, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.max_frame_size = max_frame_size
+        self.codec = get_codec(DEFAULT_CODEC)
+        self.reader = FrameReader(self.sock, max_frame_size)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.workers = {}
+        self.task_waiters = {}
+        self.result_waiters = {}
+        self.closed = False
+        reader_thread = threading.Thread(target=self.read_loop)
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def call(self, op, **args):
+        future = Future()
+        request_id = next(self.ids)
+        frame = self.codec.encode({"id": request_id, "op": op, "args": args})
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("queue owner connection lost")
+            self.pending[request_id] = future
+            send_frame(self.sock, frame, self.max_frame_size)
+        return future.result()
+
+    def read_loop(self):
+        try:
+            while True:
+                frame = self.reader.read_frame()
+                if not frame:
+                    break
+                message = self.codec.decode(frame)
+                if message.get("op") == "task":
+                    self.set_task_count(message["worker"], message["task_count"])
+                    waiter = self.task_waiters.get(message["waiter"])
+                    if waiter:
+                        waiter.deliver(PriorityTask.from_record(message["task"]))
+                elif message.get("op") == "result":
+                    waiter = self.result_waiters.get(message["waiter"])
+                    if waiter:
+                        waiter.deliver(message["result"])
+                else:
+                    with self.lock:
+                        future = self.pending.pop(message["id"])
+                    if "error" in message:
+                        future.set_exception(RuntimeError(message["error"]))
+                    else:
+                        future.set_result(message["result"])
+        except Exception as e:
+            print(f"Queue backend connection error: {e}")
+        finally:
+            with self.lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError("queue owner connection lost"))
+
+    def set_task_count(self, key, task_count):
+        worker = self.workers.get(key)
+        if worker is not None:
+            worker.task_count = task_count
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RemoteTaskQueue:
+    """The parts of TaskQueue a front-end server uses, served by the owner.
+
+    Workers' task counts are owned by the queue owner and copied back onto
+    the local Worker objects with every reply that changes them.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.workers = WorkerRegistry()
+        self._keys = itertools.count()
+
+    def add_task(
+        self,
+        priority,
+        task,
+        timeout=300,
+        run_at=None,
+        idempotency_key=None,
+        queue=None,
+    ):
+        spec = (priority, task, timeout, run_at, idempotency_key, queue)
+        return self.add_tasks([spec])[0]
+
+    def add_tasks(self, specs):
+        return self.backend.call("add_tasks", specs=list(specs))
+
+    def add_worker(self, worker):
+        worker.backend_key = f"{os.getpid()}:{next(self._keys)}"
+        self.backend.workers[worker.backend_key] = worker
+        self.workers.add(worker)
+        self.backend.call("add_worker", worker=worker.backend_key)
+
+    def remove_worker(self, worker):
+        if not self.workers.remove(worker):
+            return
+        self.backend.workers.pop(worker.backend_key, None)
+        try:
+            self.backend.call("remove_worker", worker=worker.backend_key)
+        except OSError:
+            # The owner drops this process's workers and waiters itself when
+            # the connection goes.
+            pass
+
+    def get_tasks_or_park(self, max_n, waiter=None, owner=None):
+        waiter_id = None
+        if waiter is not None:
+            waiter_id = waiter.backend_id = next(self._keys)
+            self.backend.task_waiters[waiter_id] = waiter
+        reply = self.backend.call(
+            "take",
+            max_n=max_n,
+            worker=owner.backend_key if owner else None,
+            waiter=waiter_id,
+            capacity=owner.capacity if owner else None,
+        )
+        if owner is not None:
+            owner.task_count = reply["task_count"]
+        if not reply["parked"]:
+            self.backend.task_waiters.pop(waiter_id, None)
+        return [PriorityTask.from_record(record) for record in reply["tasks"]]
+
+    def cancel_wait(self, waiter):
+        try:
+            cancelled = self.backend.call("cancel_wait", waiter=waiter.backend_id)
+        except OSError:
+            cancelled = False
+        self.backend.task_waiters.pop(waiter.backend_id, None)
+        return cancelled
+
+    def complete_task(self, task_id, owner=None):
+        worker = owner.backend_key if owner is not None else None
+        reply = self.backend.call("complete", task_id=task_id, worker=worker)
+        self.backend.set_task_count(reply["worker"], reply["task_count"])
+        return reply["completed"]
+
+    def dead_letters(self, limit=None):
+        return self.backend.call("dead_letters", limit=limit)
+
+    def retry_dead_letter(self, task_id):
+        return self.backend.call("retry_dead_letter", task_id=task_id)
+
+    def load(self):
+        """Tasks held and resident memory of the owner process."""
+        return tuple(self.backend.call("load"))
+
+    def renew_leases(self, owner):
+        owner.task_count = self.backend.call("renew", worker=owner.backend_key)
+
+    def close(self):
+        self.backend.close()
+
+
+class RemoteResultStore:
+    """The parts of ResultStore a front-end server uses, served by the owner."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._keys = itertools.count()
+
+    def put(self, task_id, result):
+        self.backend.call("result_put", task_id=task_id, result=result)
+
+    def get(self, task_id):
+        return tuple(self.backend.call("result_get", task_id=task_id))
+
+    def get_or_park(self, task_id, waiter):
+        waiter.backend_id = next(self._keys)
+        self.backend.result_waiters[waiter.backend_id] = waiter
+        found, result = self.backend.call(
+            "result_park", task_id=task_id, waiter=waiter.backend_id
+        )
+        if found:
+            self.backend.result_waiters.pop(waiter.backend_id, None)
+        return found, result
+
+    def cancel_wait(self, task_id, waiter):
+        try:
+            cancelled = self.backend.call(
+                "result_cancel", task_id=task_id, waiter=waiter.backend_id
+            )
+        except OSError:
+            cancelled = False
+        self.backend.result_waiters.pop(waiter.backend_id, None)
+        return cancelled
+
+    def __len__(self):
+        return self.backend.call("result_count")
+
+
+def wait_for_owner(socket_path, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_owner(
+    socket_path,
+    metrics_port=None,
+    scheduler=DEFAULT_SCHEDULER,
+    dispatch=DEFAULT_DISPATCH,
+    dispatch_options=None,
+):
+    try:
+        QueueOwner(
+            socket_path,
+            metrics_port=metrics_port,
+            scheduler=scheduler,
+            dispatch=dispatch,
+            dispatch_options=dispatch_options,
+        ).serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_front_end(server_class, socket_path, options):
+    server = server_class(queue_backend=socket_path, reuse_port=True, **options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def serve_processes(
+    server_class,
+    processes,
+    socket_path,
+    metrics_port=None,
+    scheduler=DEFAULT_SCHEDULER,
+    dispatch=DEFAULT_DISPATCH,
+    dispatch_options=None,
+    **options,
+):
+    """Run a queue owner plus processes front-end servers sharing one port.
+
+    With metrics_port the owner serves queue metrics on it and front-end i
+    serves its request metrics on metrics_port + 1 + i.
+    """
+    owner = multiprocessing.Process(
+        target=run_owner,
+        args=(socket_path, metrics_port, scheduler, dispatch, dispatch_options),
+    )
+    owner.start()
+    wait_for_owner(socket_path)
+    front_ends = [
+        multiprocessing.Process(
+            target=run_front_end,
+            args=(
+                server_class,
+                socket_path,
+                dict(
+                    options,
+                    metrics_port=None if metrics_port is None else metrics_port + 1 + i,
+                ),
+            ),
+        )
+        for i in range(processes)
+    ]
+    for process in front_ends:
+        process.start()
+    try:
+        for process in front_ends:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nShutdown requested...")
+    finally:
+        for process in front_ends + [owner]:
+            process.terminate()
+            process.join(timeout=5)
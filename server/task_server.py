@@ -1,51 +1,307 @@
-import json
+import argparse
+import math
 import socket
 import threading
 import time
-from collections import defaultdict
-from definitions.task_queue import TaskQueue
+from definitions.dispatch import DEFAULT_DISPATCH, DISPATCH, parse_weights
+from definitions.result_store import ResultStore, ResultWaiter
+from definitions.scheduler import DEFAULT_SCHEDULER, SCHEDULERS
+from definitions.task_queue import TaskQueue, TaskWaiter
 from definitions.worker import Worker
-from shared.encryption import add_hmac, decrypt_message, encrypt_message, verify_hmac
+from server.admission import Admission, resident_memory
+from server.metrics_http import serve_metrics
+from server.queue_backend import (
+    QueueBackend,
+    RemoteResultStore,
+    RemoteTaskQueue,
+    serve_processes,
+)
+from shared.codec import JsonCodec
+from shared.compression import COMPRESSION_THRESHOLD
+from shared.encryption import accept_hello, seal, unseal
+from shared.framing import DEFAULT_MAX_FRAME_SIZE, FrameReader, send_frame
+from shared.metrics import Metrics
+
+POLL_TYPES = ("get_task", "get_tasks")
+MESSAGE_TYPES = POLL_TYPES + (
+    "add_task",
+    "add_tasks",
+    "task_completed",
+    "get_task_result",
+    "wait_result",
+    "heartbeat",
+    "list_dead_letters",
+    "retry_dead_letter",
+)
+
+
+def finite(value, name):
+    """value if it is a finite number; raises ValueError otherwise."""
+    if (
+        isinstance(value, bool)
+        or not isinstance(value, (int, float))
+        or not math.isfinite(value)
+    ):
+        raise ValueError(f"{name} must be a finite number")
+    return value
+
+
+def run_at(spec):
+    """When an add_task spec should run: its run_at, now plus its delay, or None."""
+    if spec.get("run_at") is not None:
+        return float(finite(spec["run_at"], "run_at"))
+    if spec.get("delay") is not None:
+        return time.time() + finite(spec["delay"], "delay")
+    return None
+
+
+def integer(value, name):
+    """value if it is an int; raises ValueError otherwise."""
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{name} must be an integer")
+    return value
+
+
+def task_spec(spec):
+    """The TaskQueue.add_tasks tuple for an add_task message or add_tasks spec.
+
+    Raises ValueError for a priority that is not an int, or a timeout,
+    run_at or delay that is not a finite number.
+    """
+    return (
+        integer(spec.get("priority", 0), "priority"),
+        spec["task"],
+        finite(spec.get("timeout", 300), "timeout"),
+        run_at(spec),
+        spec.get("idempotency_key"),
+        spec.get("queue"),
+    )
+
+
+def worker_label(worker):
+    return ":".join(str(part) for part in worker.address[:2])
 
 
 class TaskQueueServer:
-    def __init__(self, host="0.0.0.0", port=5000):
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=5000,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        compression_threshold=COMPRESSION_THRESHOLD,
+        max_poll_wait=20,
+        max_batch_size=1000,
+        lease_timeout=60,
+        max_attempts=5,
+        heartbeat_timeout=30,
+        heartbeat_check_interval=1,
+        lease_check_interval=1,
+        expiry_check_interval=1,
+        queue_shards=8,
+        scheduler=DEFAULT_SCHEDULER,
+        dedupe_ttl=3600,
+        dedupe_max_keys=1000000,
+        dispatch=DEFAULT_DISPATCH,
+        dispatch_options=None,
+        result_ttl=3600,
+        result_max_bytes=64 * 1024 * 1024,
+        result_spill_dir=None,
+        max_queue_depth=None,
+        max_memory=None,
+        client_rate=None,
+        client_burst=None,
+        busy_retry_after=1.0,
+        load_check_interval=0.5,
+        queue_backend=None,
+        reuse_port=False,
+        metrics_host="127.0.0.1",
+        metrics_port=None,
+    ):
         self.host = host
         self.port = port
+        self.max_frame_size = max_frame_size
+        self.compression_threshold = compression_threshold
+        self.max_poll_wait = max_poll_wait
+        self.max_batch_size = max_batch_size
+        self.lease_check_interval = lease_check_interval
+        self.expiry_check_interval = expiry_check_interval
+        if heartbeat_timeout + heartbeat_check_interval >= lease_timeout:
+            raise ValueError("heartbeat_timeout must leave room within lease_timeout")
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_check_interval = heartbeat_check_interval
+        self.admission = Admission(
+            max_queue_depth=max_queue_depth,
+            max_memory=max_memory,
+            client_rate=client_rate,
+            client_burst=client_burst,
+            retry_after=busy_retry_after,
+        )
+        self.load_check_interval = load_check_interval
+        self.queue_backend = queue_backend
+        self.reuse_port = reuse_port
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics = Metrics()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.task_queue = TaskQueue()
+        if queue_backend:
+            # The queue lives in a separate owner process shared by every
+            # front-end server; see server.queue_backend.
+            backend = QueueBackend(queue_backend, max_frame_size)
+            self.task_queue = RemoteTaskQueue(backend)
+            self.results = RemoteResultStore(backend)
+        else:
+            self.task_queue = TaskQueue(
+                lease_timeout=lease_timeout,
+                max_attempts=max_attempts,
+                shards=queue_shards,
+                metrics=self.metrics,
+                scheduler=scheduler,
+                dedupe_ttl=dedupe_ttl,
+                dedupe_max_keys=dedupe_max_keys,
+                dispatch=dispatch,
+                dispatch_options=dispatch_options,
+            )
+            self.results = ResultStore(
+                ttl=result_ttl, max_bytes=result_max_bytes, spill_dir=result_spill_dir
+            )
+            self.metrics.gauge("queue_depth", self.task_queue.depth_by_priority)
+            self.metrics.gauge(
+                "tasks_expired", lambda: {None: self.task_queue.expired_count}
+            )
+            self.metrics.gauge(
+                "tasks_scheduled", lambda: {None: self.task_queue.scheduled_count}
+            )
+            self.metrics.gauge(
+                "tasks_deduplicated", lambda: {None: self.task_queue.dedupe.hits}
+            )
+        self.metrics.gauge("results_stored", lambda: {None: len(self.results)})
         self.client_handlers = {}
-        self.stats = defaultdict(int)
-        self.stats_lock = threading.Lock()
-        self.running = True  
+        self.running = True
 
     def check_worker_heartbeats(self):
+        """Drop workers silent for heartbeat_timeout; renew the others' leases.
+
+        Any frame from a worker, or a long-poll it has parked, counts as a
+        heartbeat. The sweep only visits workers whose deadline has come up,
+        and renews leases for those still talking, so a worker busy on long
+        tasks keeps them without sending anything extra.
+        """
+        workers = self.task_queue.workers
         while self.running:
             try:
-                current_time = time.time()
-                with self.task_queue.lock:
-                    for worker in self.task_queue.workers[:]:
-                        if current_time - worker.last_heartbeat > 30:
-                            print(f"worker {worker.address} timed out")
-                            self.task_queue.remove_worker(worker)
-                time.sleep(10)
+                expired, alive = workers.sweep(time.time(), self.heartbeat_timeout)
+                for worker in alive:
+                    self.task_queue.renew_leases(worker)
+                for worker in expired:
+                    print(f"worker {worker.address} timed out")
+                    self.metrics.inc("workers_timed_out")
+                    self.unregister_worker(worker)
+                    self.disconnect_worker(worker)
+                time.sleep(self.heartbeat_check_interval)
             except Exception as e:
                 print(f"Error in heartbeat checker: {e}")
 
+    def disconnect_worker(self, worker):
+        """Close a timed-out worker's connection so its handler exits."""
+        try:
+            worker.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def check_leases(self):
+        while self.running:
+            try:
+                requeued, dead_lettered = self.task_queue.reclaim_expired_leases()
+                if requeued or dead_lettered:
+                    self.metrics.inc("tasks_requeued", requeued)
+                    self.metrics.inc("tasks_dead_lettered", dead_lettered)
+                else:
+                    time.sleep(self.lease_check_interval)
+            except Exception as e:
+                print(f"Error in lease checker: {e}")
+
+    def reap_expired_tasks(self):
+        while self.running:
+            try:
+                if not self.task_queue.reap_expired():
+                    time.sleep(self.expiry_check_interval)
+            except Exception as e:
+                print(f"Error in expiry reaper: {e}")
+
+    def promote_scheduled_tasks(self):
+        while self.running:
+            try:
+                self.metrics.inc("tasks_promoted", self.task_queue.promote_scheduled())
+            except Exception as e:
+                print(f"Error in task scheduler: {e}")
+
+    def queue_load(self):
+        """Tasks held and resident memory of the process holding them."""
+        if self.queue_backend:
+            return self.task_queue.load()
+        return (
+            len(self.task_queue) + self.task_queue.scheduled_count,
+            resident_memory(),
+        )
+
+    def check_load(self):
+        while self.running:
+            try:
+                self.admission.update(*self.queue_load())
+            except Exception as e:
+                print(f"Error in load checker: {e}")
+            time.sleep(self.load_check_interval)
+
+    def admit(self, address, n):
+        """None if n tasks may be enqueued, else a busy response."""
+        refused = self.admission.admit(address[0], n)
+        if refused is None:
+            return None
+        reason, retry_after = refused
+        self.metrics.inc("tasks_rejected", n, reason)
+        return {
+            "status": "busy",
+            "retry_after": round(retry_after, 3),
+            "message": f"server busy ({reason})",
+        }
+
+    def start_monitors(self):
+        # With a shared backend the owner process reaps, reclaims and
+        # promotes scheduled tasks.
+        if not self.queue_backend:
+            scheduled_thread = threading.Thread(target=self.promote_scheduled_tasks)
+            scheduled_thread.daemon = True
+            scheduled_thread.start()
+
+            expiry_thread = threading.Thread(target=self.reap_expired_tasks)
+            expiry_thread.daemon = True
+            expiry_thread.start()
+
+            lease_thread = threading.Thread(target=self.check_leases)
+            lease_thread.daemon = True
+            lease_thread.start()
+
+        if self.admission.watches_load:
+            load_thread = threading.Thread(target=self.check_load)
+            load_thread.daemon = True
+            load_thread.start()
+
+        heartbeat_thread = threading.Thread(target=self.check_worker_heartbeats)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        if self.metrics_port is not None:
+            serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+
     def start(self):
         try:
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.sock.bind((self.host, self.port))
             self.sock.listen(100)
             print(f"server is listening on {self.host}:{self.port}")
-
-            heartbeat_thread = threading.Thread(target=self.check_worker_heartbeats)
-            heartbeat_thread.daemon = True
-            heartbeat_thread.start()
-
-            stats_thread = threading.Thread(target=self.print_stats)
-            stats_thread.daemon = True
-            stats_thread.start()
+            self.start_monitors()
 
             while self.running:
                 try:
@@ -66,78 +322,79 @@ class TaskQueueServer:
 
     def handle_client(self, client_socket, address):
         worker = None
+        # Every get_task parked on this connection, so none outlives it.
+        waiters = set()
+        reader = FrameReader(client_socket, self.max_frame_size)
+        send_lock = threading.Lock()
+        session = None
+        first_frame = True
+
+        def respond(response, data, started=None):
+            payload = self.encode_response(response, data, session)
+            with send_lock:
+                # Session nonces must go out in the order they are used.
+                if session:
+                    with self.metrics.timer("crypto_seconds", "encrypt"):
+                        payload = session.encrypt(payload)
+                send_frame(client_socket, payload, self.max_frame_size)
+            if started is not None:
+                self.record_request(data, started)
+
         try:
             while True:
                 try:
-                    encrypted = client_socket.recv(1024)
+                    encrypted = reader.read_frame()
                     if not encrypted:
                         print(f"Client {address} disconnected")
                         break
+                    started = time.perf_counter()
+                    if worker:
+                        worker.update_heartbeat()
 
-                    try:
-                        data = decrypt_message(encrypted)
-                        if data is None:
-                            print(f"Decryption failed for {address}, no valid data.")
-                            response = {
-                                "status": "error",
-                                "message": "decryption failed",
-                            }
-                    except Exception as e:
-                        print(f"Decryption error from {address}: {e}")
-                        response = {"status": "error", "message": "decryption error"}
-                        break  
-
-                    if not verify_hmac(data):
-                        print(f"Invalid HMAC from {address}")
-                        response = {"status": "error", "message": "invalid hmac"}
-                    elif data["type"] == "add_task":
-                        task_id = self.task_queue.add_task(
-                            data.get("priority", 0),
-                            data["task"],
-                            data.get("timeout", 300),
+                    if first_frame:
+                        first_frame = False
+                        hello, session = self.accept_hello(encrypted)
+                        if hello:
+                            with send_lock:
+                                send_frame(client_socket, hello, self.max_frame_size)
+                            continue
+
+                    data, response = self.decode_frame(encrypted, address, session)
+                    if response is None and data["type"] in POLL_TYPES:
+                        worker = self.register_worker(
+                            worker, client_socket, address, data
+                        )
+                        response, waiter = self.poll_task(
+                            worker, data, TaskWaiter(worker)
+                        )
+                        if waiter:
+                            # Keep reading completions and heartbeats while
+                            # the get_task is parked; it is answered later.
+                            waiters.add(waiter)
+                            poller = threading.Thread(
+                                target=self.finish_poll,
+                                args=(waiter, waiters, worker, data, respond, started),
+                            )
+                            poller.daemon = True
+                            poller.start()
+                            continue
+                    elif response is None and data["type"] == "wait_result":
+                        response, result_waiter = self.poll_result(data, ResultWaiter())
+                        if result_waiter:
+                            poller = threading.Thread(
+                                target=self.finish_result_poll,
+                                args=(result_waiter, data, respond, started),
+                            )
+                            poller.daemon = True
+                            poller.start()
+                            continue
+                    elif response is None:
+                        response, worker = self.handle_message(
+                            data, worker, client_socket, address
                         )
-                        response = {"status": "ok", "task_id": task_id}
-                        with self.stats_lock:
-                            self.stats["tasks_added"] += 1
-                    elif data["type"] == "get_task":
-                        if not worker:
-                            worker = Worker(client_socket, address)
-                            self.task_queue.add_worker(worker)
-                            print(f"New worker registered: {address}")
-                        task = self.task_queue.get_task()
-                        if task:
-                            worker.increment_task_count()
-                            response = {
-                                "status": "ok",
-                                "task_id": task.task_id,
-                                "task": task.task,
-                            }
-                            with self.stats_lock:
-                                self.stats["tasks_assigned"] += 1
-                        else:
-                            response = {"status": "empty"}
-                    elif data["type"] == "task_completed":
-                        task_id = data.get("task_id")
-                        if worker and task_id:
-                            worker.decrement_task_count()
-                            response = {"status": "ok"}
-                            with self.stats_lock:
-                                self.stats["tasks_completed"] += 1
-                        else:
-                            response = {
-                                "status": "error",
-                                "message": "invalid task completion",
-                            }
-                    elif data["type"] == "heartbeat":
-                        if worker:
-                            worker.update_heartbeat()
-                        response = {"status": "ok"}
-                    else:
-                        response = {"status": "error", "message": "unknown type"}
 
                     try:
-                        encrypted_response = encrypt_message(add_hmac(response))
-                        client_socket.sendall(encrypted_response)
+                        respond(response, data, started)
                     except Exception as e:
                         print(f"Error sending response to {address}: {e}")
                         break
@@ -152,38 +409,412 @@ class TaskQueueServer:
         except Exception as e:
             print(f"Error handling client {address}: {e}")
         finally:
+            for waiter in list(waiters):
+                self.task_queue.cancel_wait(waiter)
             if worker:
                 print(f"Removing worker {address}")
-                self.task_queue.remove_worker(worker)
+                self.unregister_worker(worker)
             try:
                 client_socket.close()
             except:
                 pass
             self.client_handlers.pop(address, None)
 
-    def print_stats(self):
-        while self.running:
+    def finish_poll(self, waiter, waiters, worker, data, respond, started=None):
+        waiter.event.wait(self.poll_wait(data))
+        waiters.discard(waiter)
+        worker.parked = False
+        worker.update_heartbeat()
+        tasks = [] if self.task_queue.cancel_wait(waiter) else [waiter.task]
+        try:
+            respond(self.task_response(worker, tasks, data), data, started)
+        except Exception as e:
+            print(f"Error sending task to {worker.address}: {e}")
+
+    def finish_result_poll(self, waiter, data, respond, started=None):
+        waiter.event.wait(self.poll_wait(data))
+        if self.results.cancel_wait(data["task_id"], waiter):
+            response = {"status": "pending"}
+        else:
+            response = {"status": "ok", "result": waiter.result}
+        try:
+            respond(response, data, started)
+        except Exception as e:
+            print(f"Error sending result for {data['task_id']}: {e}")
+
+    def accept_hello(self, frame):
+        return accept_hello(
+            frame,
+            compression_threshold=self.compression_threshold,
+            max_message_size=self.max_frame_size,
+        )
+
+    def decode_frame(self, encrypted, address, session=None):
+        """Return (data, None), or (None, error response) for a bad frame.
+
+        A session frame that fails authentication raises SessionError,
+        which ends the connection. A poll with an invalid capacity gets
+        (data, error response), before its worker is registered.
+        """
+        with self.metrics.timer("crypto_seconds", "unseal"):
+            data = session.unseal(encrypted) if session else unseal(encrypted)
+        if data is None:
+            print(f"Invalid message from {address}")
+            return None, {"status": "error", "message": "invalid message"}
+        if data.get("type") in POLL_TYPES and "capacity" in data:
             try:
-                time.sleep(60)
-                with self.stats_lock:
-                    print(f"Stats: {dict(self.stats)}")
-            except Exception as e:
-                print(f"Error printing stats: {e}")
+                if integer(data["capacity"], "capacity") < 1:
+                    raise ValueError("capacity must be positive")
+            except ValueError as e:
+                return data, {"status": "error", "message": str(e)}
+        return data, None
+
+    def encode_response(self, response, data=None, session=None):
+        """Sealed response, or with a session the plaintext for session.encrypt."""
+        # Lets a worker tell the reply to its get_task apart from heartbeat
+        # and completion acks, and lets pipelining clients match replies.
+        if data is not None:
+            response["reply_to"] = data.get("type")
+            if "request_id" in data:
+                response["request_id"] = data["request_id"]
+        # Reply in the codec the request came in; undecodable requests get
+        # a format every client understands.
+        with self.metrics.timer("crypto_seconds", "seal"):
+            if session:
+                return session.encode(response, getattr(data, "codec", JsonCodec.name))
+            return seal(response, getattr(data, "codec", "legacy"))
+
+    def record_request(self, data, started):
+        """Time from a frame arriving to its response going out, by type."""
+        message_type = data.get("type") if data is not None else None
+        if message_type not in MESSAGE_TYPES:
+            message_type = "invalid" if data is None else "unknown"
+        self.metrics.observe(
+            "request_seconds", time.perf_counter() - started, message_type
+        )
+
+    def poll_wait(self, data):
+        try:
+            return max(0.0, min(float(data.get("wait", 0)), self.max_poll_wait))
+        except (TypeError, ValueError):
+            return 0.0
+
+    def register_worker(self, worker, connection, address, data):
+        if not worker:
+            worker = Worker(connection, address)
+            self.task_queue.add_worker(worker)
+            print(f"New worker registered: {address}")
+        if "capacity" in data:
+            worker.capacity = data["capacity"]
+        worker.update_heartbeat()
+        return worker
+
+    def unregister_worker(self, worker):
+        self.task_queue.remove_worker(worker)
+        self.metrics.remove("worker_tasks_completed", worker_label(worker))
+
+    def poll_task(self, worker, data, waiter=None):
+        """Return (response, None), or (None, waiter) if get_task was parked."""
+        if not worker.has_credit():
+            return {"status": "busy"}, None
+        if self.poll_wait(data) <= 0:
+            waiter = None
+        max_n = 1
+        if data["type"] == "get_tasks":
+            max_n = worker.available_credit(self.batch_size(data))
+        tasks = self.task_queue.get_tasks_or_park(max_n, waiter, worker)
+        if tasks or not waiter:
+            return self.task_response(worker, tasks, data), None
+        worker.parked = True
+        return None, waiter
+
+    def poll_result(self, data, waiter=None):
+        """Return (response, None), or (None, waiter) if wait_result was parked."""
+        if self.poll_wait(data) <= 0:
+            found, result = self.results.get(data["task_id"])
+        else:
+            found, result = self.results.get_or_park(data["task_id"], waiter)
+            if not found:
+                return None, waiter
+        if found:
+            return {"status": "ok", "result": result}, None
+        return {"status": "pending"}, None
+
+    def batch_size(self, data):
+        try:
+            return max(1, min(int(data.get("max_n", 1)), self.max_batch_size))
+        except (TypeError, ValueError):
+            return 1
+
+    def task_response(self, worker, tasks, data):
+        if not tasks:
+            return {"status": "empty"}
+        self.metrics.inc("tasks_assigned", len(tasks))
+        if data["type"] == "get_tasks":
+            return {
+                "status": "ok",
+                "tasks": [
+                    {
+                        "task_id": task.task_id,
+                        "task": task.task,
+                        "timeout": task.timeout,
+                    }
+                    for task in tasks
+                ],
+            }
+        return {
+            "status": "ok",
+            "task_id": tasks[0].task_id,
+            "task": tasks[0].task,
+            "timeout": tasks[0].timeout,
+        }
+
+    def enqueue(self, data, address):
+        """Response to an add_task or add_tasks message."""
+        specs = [data] if data["type"] == "add_task" else data["tasks"]
+        if len(specs) > self.max_batch_size:
+            return {
+                "status": "error",
+                "message": f"batch larger than {self.max_batch_size} tasks",
+            }
+        try:
+            specs = [task_spec(spec) for spec in specs]
+        except (AttributeError, KeyError, OverflowError, TypeError, ValueError) as e:
+            return {"status": "error", "message": f"invalid task: {e}"}
+        response = self.admit(address, len(specs))
+        if response is not None:
+            return response
+        task_ids = self.task_queue.add_tasks(specs)
+        self.metrics.inc("tasks_added", len(task_ids))
+        if data["type"] == "add_task":
+            return {"status": "ok", "task_id": task_ids[0]}
+        return {"status": "ok", "task_ids": task_ids}
+
+    def store_result(self, task_id, result):
+        """Store a completed task's result; results must be JSON-serializable."""
+        try:
+            self.results.put(task_id, result)
+        except (TypeError, ValueError, RuntimeError) as e:
+            # RuntimeError is how the queue owner reports the same failure.
+            print(f"Result for task {task_id} not stored: {e}")
+            return {"status": "error", "message": f"result not stored: {e}"}
+        return {"status": "ok"}
+
+    def handle_message(self, data, worker, connection, address):
+        if data["type"] in ("add_task", "add_tasks"):
+            response = self.enqueue(data, address)
+        elif data["type"] in POLL_TYPES:
+            worker = self.register_worker(worker, connection, address, data)
+            response, _ = self.poll_task(worker, data)
+        elif data["type"] == "task_completed":
+            task_id = data.get("task_id")
+            if worker and task_id:
+                # A completion for a lease that already expired, or that
+                # another worker holds, is still acknowledged, but only the
+                # lease holder's result is kept.
+                completed = self.task_queue.complete_task(task_id, worker)
+                response = {"status": "ok"}
+                if completed:
+                    self.metrics.inc("tasks_completed")
+                    self.metrics.inc(
+                        "worker_tasks_completed", label=worker_label(worker)
+                    )
+                    response = self.store_result(task_id, data.get("result"))
+                else:
+                    self.metrics.inc("stale_completions")
+            else:
+                response = {
+                    "status": "error",
+                    "message": "invalid task completion",
+                }
+        elif data["type"] in ("get_task_result", "wait_result"):
+            response, _ = self.poll_result(dict(data, wait=0))
+        elif data["type"] == "heartbeat":
+            # Any frame counts as a heartbeat; this one only has to be acked.
+            response = {"status": "ok"}
+        elif data["type"] == "list_dead_letters":
+            response = {
+                "status": "ok",
+                "tasks": [
+                    {
+                        "task_id": record["task_id"],
+                        "task": record["task"],
+                        "attempts": record["attempts"],
+                    }
+                    for record in self.task_queue.dead_letters(self.max_batch_size)
+                ],
+            }
+        elif data["type"] == "retry_dead_letter":
+            task_id = data.get("task_id")
+            if task_id and self.task_queue.retry_dead_letter(task_id):
+                response = {"status": "ok"}
+            else:
+                response = {"status": "error", "message": "no such dead letter"}
+        else:
+            response = {"status": "error", "message": "unknown type"}
+        return response, worker
 
     def shutdown(self):
         print("Shutting down server...")
         self.running = False
-        for handler in self.client_handlers.values():
+        for handler in list(self.client_handlers.values()):
             handler.join(timeout=1)
         try:
             self.sock.close()
         except:
             pass
+        self.task_queue.close()
         print("Server shutdown complete")
 
 
 if __name__ == "__main__":
-    server = TaskQueueServer()
+    parser = argparse.ArgumentParser(description="Run the task queue server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="serve all connections from one asyncio event loop",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="accept on the port from this many processes sharing one queue",
+    )
+    parser.add_argument(
+        "--queue-socket",
+        default="/tmp/taskqueue.sock",
+        help="unix socket of the queue owner when --processes > 1",
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=sorted(SCHEDULERS),
+        default=DEFAULT_SCHEDULER,
+        help="which parked worker gets the next task",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=9100,
+        help="serve metrics on 127.0.0.1 at this port; 0 turns them off",
+    )
+    parser.add_argument(
+        "--heartbeat-timeout",
+        type=float,
+        default=30,
+        help="drop a worker after this many seconds without any traffic",
+    )
+    parser.add_argument(
+        "--heartbeat-check-interval",
+        type=float,
+        default=1,
+        help="how often silent workers are looked for, bounding detection lag",
+    )
+    parser.add_argument(
+        "--compression-threshold",
+        type=int,
+        default=COMPRESSION_THRESHOLD,
+        help="compress responses this large on sessions that negotiated it",
+    )
+    parser.add_argument(
+        "--dispatch",
+        choices=sorted(DISPATCH),
+        default=DEFAULT_DISPATCH,
+        help="strict priority order, or weighted fair across priorities and queues",
+    )
+    parser.add_argument(
+        "--aging",
+        type=float,
+        default=0,
+        help="strict: priority levels a queued task gains per second",
+    )
+    parser.add_argument(
+        "--weights",
+        default="",
+        help="fair: per-priority weights, e.g. 0:1,2:4 (default 2**priority)",
+    )
+    parser.add_argument(
+        "--queue-weights",
+        default="",
+        help="fair: per-queue weights, e.g. tenant-a:2,tenant-b:1 (default 1)",
+    )
+    parser.add_argument(
+        "--max-queue-depth",
+        type=int,
+        default=0,
+        help="answer enqueues busy while this many tasks are held; 0 is no limit",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=0,
+        help="answer enqueues busy while the queue's process uses this many "
+        "resident bytes; 0 is no limit",
+    )
+    parser.add_argument(
+        "--client-rate",
+        type=float,
+        default=0,
+        help="tasks a second each client host may enqueue (per process); 0 is no limit",
+    )
+    parser.add_argument(
+        "--client-burst",
+        type=int,
+        default=0,
+        help="tasks a client host may enqueue at once (default the client rate)",
+    )
+    args = parser.parse_args()
+
+    if args.dispatch == "fair":
+        dispatch_options = {
+            "weights": parse_weights(args.weights, int),
+            "queue_weights": parse_weights(args.queue_weights),
+        }
+    else:
+        dispatch_options = {"aging": args.aging}
+    metrics_port = args.metrics_port or None
+    server_class = TaskQueueServer
+    if args.use_async:
+        from server.async_server import AsyncTaskQueueServer
+
+        server_class = AsyncTaskQueueServer
+    if args.processes > 1:
+        serve_processes(
+            server_class,
+            args.processes,
+            args.queue_socket,
+            metrics_port=metrics_port,
+            scheduler=args.scheduler,
+            dispatch=args.dispatch,
+            dispatch_options=dispatch_options,
+            host=args.host,
+            port=args.port,
+            heartbeat_timeout=args.heartbeat_timeout,
+            heartbeat_check_interval=args.heartbeat_check_interval,
+            compression_threshold=args.compression_threshold,
+            max_queue_depth=args.max_queue_depth or None,
+            max_memory=args.max_memory or None,
+            client_rate=args.client_rate or None,
+            client_burst=args.client_burst or None,
+        )
+        raise SystemExit
+    server = server_class(
+        host=args.host,
+        port=args.port,
+        metrics_port=metrics_port,
+        scheduler=args.scheduler,
+        dispatch=args.dispatch,
+        dispatch_options=dispatch_options,
+        heartbeat_timeout=args.heartbeat_timeout,
+        heartbeat_check_interval=args.heartbeat_check_interval,
+        compression_threshold=args.compression_threshold,
+        max_queue_depth=args.max_queue_depth or None,
+        max_memory=args.max_memory or None,
+        client_rate=args.client_rate or None,
+        client_burst=args.client_burst or None,
+    )
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,47 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # optional; the JSON codec works everywhere
+    msgpack = None
+
+
+class JsonCodec:
+    id = 1
+    name = "json"
+
+    @staticmethod
+    def encode(message):
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def decode(body):
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    id = 2
+    name = "msgpack"
+
+    @staticmethod
+    def encode(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(body):
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+
+
+CODECS = {JsonCodec.name: JsonCodec}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+DEFAULT_CODEC = MsgpackCodec.name if msgpack is not None else JsonCodec.name
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"unknown or unavailable codec: {name}")
@@ -0,0 +1,169 @@
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:  # optional; zlib works everywhere
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib works everywhere
+    zstandard = None
+
+# Message bodies shorter than this go out as they are; compressing a few
+# hundred bytes costs more CPU than it saves on the wire.
+COMPRESSION_THRESHOLD = 1024
+# Bodies are fed to the compressor, and inflated, this much at a time, so a
+# payload that inflates past its limit is stopped without being expanded.
+# That is all the streaming buys: a message is still held whole, since a
+# frame is sealed in one AEAD pass and the codecs decode complete bodies,
+# so per-message memory is bounded by max_frame_size, not by the chunk.
+STREAM_CHUNK = 256 * 1024
+
+
+class DecompressionError(ValueError):
+    pass
+
+
+def chunks(data, size=STREAM_CHUNK):
+    view = memoryview(data)
+    for start in range(0, len(view), size):
+        yield view[start : start + size]
+
+
+class _Limit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.total = 0
+
+    def check(self, out):
+        self.total += len(out)
+        if self.total > self.limit:
+            raise DecompressionError(f"payload inflates past {self.limit} bytes")
+        return out
+
+
+class ZlibCompression:
+    id = 1
+    name = "zlib"
+    level = 6
+
+    @classmethod
+    def compress_stream(cls, pieces):
+        compressor = zlib.compressobj(cls.level)
+        for piece in pieces:
+            out = compressor.compress(piece)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    @staticmethod
+    def decompress_stream(pieces, limit):
+        decompressor = zlib.decompressobj()
+        limit = _Limit(limit)
+        for piece in pieces:
+            while piece:
+                yield limit.check(decompressor.decompress(piece, STREAM_CHUNK))
+                piece = decompressor.unconsumed_tail
+        yield limit.check(decompressor.flush())
+        if not decompressor.eof:
+            raise DecompressionError("truncated zlib stream")
+
+
+class Lz4Compression:
+    id = 2
+    name = "lz4"
+
+    @staticmethod
+    def compress_stream(pieces):
+        compressor = lz4.frame.LZ4FrameCompressor()
+        yield compressor.begin()
+        for piece in pieces:
+            out = compressor.compress(piece)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    @staticmethod
+    def decompress_stream(pieces, limit):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        limit = _Limit(limit)
+        for piece in pieces:
+            while not decompressor.eof:
+                yield limit.check(decompressor.decompress(piece, STREAM_CHUNK))
+                piece = b""
+                if decompressor.needs_input:
+                    break
+        if not decompressor.eof:
+            raise DecompressionError("truncated lz4 stream")
+
+
+class ZstdCompression:
+    id = 3
+    name = "zstd"
+    level = 3
+
+    @classmethod
+    def compress_stream(cls, pieces):
+        compressor = zstandard.ZstdCompressor(level=cls.level).compressobj()
+        for piece in pieces:
+            out = compressor.compress(piece)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    @staticmethod
+    def decompress_stream(pieces, limit):
+        # zstd's decompressobj has no output bound, so read through a
+        # stream reader that pulls input as it needs it. The reader doesn't
+        # report a truncated frame; sessions only inflate authenticated
+        # frames, so one can't arrive cut short.
+        reader = zstandard.ZstdDecompressor().stream_reader(_PieceReader(pieces))
+        limit = _Limit(limit)
+        while True:
+            out = reader.read(STREAM_CHUNK)
+            if not out:
+                break
+            yield limit.check(out)
+
+
+class _PieceReader:
+    """A read()-able view of an iterable of byte pieces."""
+
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+
+    def read(self, size=-1):
+        return bytes(next(self.pieces, b""))
+
+
+# In order of preference when a client offers them all.
+COMPRESSIONS = {}
+if zstandard is not None:
+    COMPRESSIONS[ZstdCompression.name] = ZstdCompression
+if lz4 is not None:
+    COMPRESSIONS[Lz4Compression.name] = Lz4Compression
+COMPRESSIONS[ZlibCompression.name] = ZlibCompression
+COMPRESSIONS_BY_ID = {
+    compression.id: compression for compression in COMPRESSIONS.values()
+}
+
+DEFAULT_COMPRESSION = next(iter(COMPRESSIONS))
+
+
+def get_compression(name):
+    try:
+        return COMPRESSIONS[name]
+    except KeyError:
+        raise ValueError(f"unknown or unavailable compression: {name}")
+
+
+def compress(compression, body):
+    """Compress a whole message body; the result is built in memory."""
+    return b"".join(compression.compress_stream(chunks(body)))
+
+
+def decompress(compression, data, limit):
+    """Inflate a whole message, raising DecompressionError if it grows past
+    limit bytes. The output is built in memory, up to limit."""
+    return b"".join(compression.decompress_stream(chunks(data), limit))
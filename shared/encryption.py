@@ -1,12 +1,50 @@
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import base64
 import hmac
 import hashlib
 import json
+import os
+from shared.codec import CODECS_BY_ID, DEFAULT_CODEC, get_codec
+from shared.compression import (
+    COMPRESSION_THRESHOLD,
+    COMPRESSIONS,
+    COMPRESSIONS_BY_ID,
+    DEFAULT_COMPRESSION,
+    compress,
+    decompress,
+    get_compression,
+)
+from shared.framing import DEFAULT_MAX_FRAME_SIZE
 
-ENCRYPTION_KEY = Fernet.generate_key()
-HMAC_KEY = ENCRYPTION_KEY  
+
+def load_key():
+    """The shared secret, as a urlsafe-base64 32-byte key (Fernet's format).
+
+    Read from TASKQUEUE_KEY or the file named by TASKQUEUE_KEY_FILE. Without
+    either a random key is generated, which only lets peers in the same
+    process talk to each other.
+    """
+    key = os.environ.get("TASKQUEUE_KEY")
+    key_file = os.environ.get("TASKQUEUE_KEY_FILE")
+    if not key and key_file:
+        with open(key_file, "rb") as f:
+            key = f.read().strip()
+    if not key:
+        return Fernet.generate_key()
+    key = key.encode("ascii") if isinstance(key, str) else key
+    if len(base64.urlsafe_b64decode(key)) != 32:
+        raise ValueError("TASKQUEUE_KEY must be urlsafe base64 of 32 bytes")
+    return key
+
+
+ENCRYPTION_KEY = load_key()
+HMAC_KEY = ENCRYPTION_KEY
 cipher = Fernet(ENCRYPTION_KEY)
+MASTER_KEY = base64.urlsafe_b64decode(ENCRYPTION_KEY)
 
 
 def encrypt_message(message):
@@ -75,3 +113,283 @@ def verify_hmac(message):
         )
     except Exception:
         return False
+
+
+class SessionError(ConnectionError):
+    """A session frame failed authentication; the connection must close."""
+
+
+class Message(dict):
+    """A decoded message that remembers the codec it arrived in, so replies
+    can go back the same way."""
+
+    __slots__ = ("codec",)
+
+    def __init__(self, fields, codec):
+        super().__init__(fields)
+        self.codec = codec
+
+
+def seal(message, codec=DEFAULT_CODEC):
+    """Encode message once, MAC those bytes and encrypt them.
+
+    The plaintext is one codec id byte, the raw HMAC-SHA256 of the body and
+    the body itself, so neither side re-serializes or copies the message to
+    check the MAC. codec="legacy" sends encrypt_message(add_hmac(message))
+    for peers that predate codecs.
+    """
+    if codec == "legacy":
+        return encrypt_message(add_hmac(message))
+    codec = get_codec(codec)
+    try:
+        body = codec.encode(message)
+        mac = hmac.digest(HMAC_KEY, body, "sha256")
+        return cipher.encrypt(bytes((codec.id,)) + mac + body)
+    except Exception as e:
+        raise ValueError(f"encryption error: {str(e)}")
+
+
+def unseal(encrypted_data):
+    """Decrypt and verify a sealed (or legacy) message; returns a Message or None."""
+    if not encrypted_data:
+        print("error: encrypted data is empty or None")
+        return None
+
+    try:
+        plaintext = cipher.decrypt(encrypted_data)
+    except InvalidToken as e:
+        print(f"decryption failed: invalid token (key mismatch or corrupt data). {e}")
+        return None
+
+    try:
+        if plaintext[:1] == b"{":
+            message = json.loads(plaintext.decode("utf-8"))
+            if not verify_hmac(message):
+                print("invalid hmac")
+                return None
+            message.pop("hmac")
+            return Message(message, "legacy")
+
+        codec = CODECS_BY_ID.get(plaintext[0])
+        if codec is None:
+            print(f"unknown codec id {plaintext[0]}")
+            return None
+        mac, body = plaintext[1:33], plaintext[33:]
+        if not hmac.compare_digest(mac, hmac.digest(HMAC_KEY, body, "sha256")):
+            print("invalid hmac")
+            return None
+        message = codec.decode(body)
+        if not isinstance(message, dict):
+            print("message is not a mapping")
+            return None
+        return Message(message, codec.name)
+
+    except Exception as e:
+        print(f"message decode error: {e}")
+        return None
+
+
+# Per-connection AEAD sessions. The client opens with a plaintext hello
+# carrying a cipher id and a random salt, the server answers with its own
+# salt, and both derive one key per direction from the shared secret and
+# the two salts. Every frame after that is a single AEAD pass over
+# codec id + body, with the frame's index on the connection as its nonce.
+# The hello may also list compression ids the client accepts, best first;
+# the server's reply then names the one it picked (0 for none), covered by
+# the confirmation MAC. Bodies at or above the session's threshold are
+# compressed before encryption and flagged in the codec id byte.
+
+HELLO = b"TQHELLO1"
+SALT_SIZE = 16
+CIPHERS = {"aes-gcm": (1, AESGCM), "chacha20": (2, ChaCha20Poly1305)}
+CIPHERS_BY_ID = {cipher_id: name for name, (cipher_id, _) in CIPHERS.items()}
+DEFAULT_CIPHER = "aes-gcm"
+COMPRESSED = 0x80
+
+
+def is_hello(frame):
+    return frame[: len(HELLO)] == HELLO
+
+
+def _derive(salt, direction):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=direction).derive(
+        MASTER_KEY
+    )
+
+
+def _confirm(client_hello, server_salt):
+    return hmac.digest(MASTER_KEY, client_hello + server_salt, "sha256")
+
+
+class Session:
+    """One side of an AEAD session. encrypt() and unseal() each take the next
+    nonce, so frames must be encrypted in the order they are sent and
+    unsealed in the order they arrive."""
+
+    def __init__(
+        self,
+        cipher_name,
+        send_key,
+        recv_key,
+        compression=None,
+        compression_threshold=COMPRESSION_THRESHOLD,
+        max_message_size=DEFAULT_MAX_FRAME_SIZE,
+    ):
+        aead = CIPHERS[cipher_name][1]
+        self.cipher_name = cipher_name
+        self.sender = aead(send_key)
+        self.receiver = aead(recv_key)
+        self.send_counter = 0
+        self.recv_counter = 0
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.max_message_size = max_message_size
+
+    def encode(self, message, codec=DEFAULT_CODEC):
+        """Plaintext for encrypt(); safe to call from any thread."""
+        codec = get_codec(codec)
+        body = codec.encode(message)
+        if self.compression and len(body) >= self.compression_threshold:
+            compressed = compress(self.compression, body)
+            if len(compressed) < len(body):
+                return bytes((codec.id | COMPRESSED,)) + compressed
+        return bytes((codec.id,)) + body
+
+    def encrypt(self, plaintext):
+        nonce = self.send_counter.to_bytes(12, "big")
+        self.send_counter += 1
+        return self.sender.encrypt(nonce, plaintext, None)
+
+    def seal(self, message, codec=DEFAULT_CODEC):
+        return self.encrypt(self.encode(message, codec))
+
+    def unseal(self, frame):
+        """Decrypt and decode the next frame; returns a Message or None.
+
+        Raises SessionError if the frame fails authentication: nonces are
+        frame counters, so after a lost or forged frame no later one can
+        be trusted to line up, and the connection has to be dropped.
+        """
+        nonce = self.recv_counter.to_bytes(12, "big")
+        try:
+            plaintext = self.receiver.decrypt(nonce, frame, None)
+        except InvalidTag:
+            raise SessionError(
+                "decryption failed: invalid tag (key mismatch or corrupt data)"
+            )
+        self.recv_counter += 1
+        try:
+            codec = CODECS_BY_ID.get(plaintext[0] & ~COMPRESSED)
+            if codec is None:
+                print(f"unknown codec id {plaintext[0]}")
+                return None
+            if not plaintext[0] & COMPRESSED:
+                body = plaintext[1:]
+            elif self.compression is None:
+                print("compressed message on an uncompressed session")
+                return None
+            else:
+                body = decompress(
+                    self.compression, memoryview(plaintext)[1:], self.max_message_size
+                )
+            message = codec.decode(body)
+            if not isinstance(message, dict):
+                print("message is not a mapping")
+                return None
+            return Message(message, codec.name)
+        except Exception as e:
+            print(f"message decode error: {e}")
+            return None
+
+
+class ClientHello:
+    """Opens a session; compression is a name from COMPRESSIONS, or "none".
+
+    Every available compression is offered with the chosen one first, so a
+    server lacking it still picks another.
+    """
+
+    def __init__(
+        self,
+        cipher_name=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+        compression_threshold=COMPRESSION_THRESHOLD,
+        max_message_size=DEFAULT_MAX_FRAME_SIZE,
+    ):
+        if cipher_name not in CIPHERS:
+            raise ValueError(f"unknown cipher: {cipher_name}")
+        self.cipher_name = cipher_name
+        self.compression_threshold = compression_threshold
+        self.max_message_size = max_message_size
+        self.offers = b""
+        if compression != "none":
+            first = get_compression(compression)
+            self.offers = bytes(
+                [first.id] + [c.id for c in COMPRESSIONS.values() if c is not first]
+            )
+        self.salt = os.urandom(SALT_SIZE)
+        self.frame = HELLO + bytes((CIPHERS[cipher_name][0],)) + self.salt + self.offers
+
+    def finish(self, reply):
+        """Build the session from the server's reply to frame."""
+        choice_size = 1 if self.offers else 0
+        if (
+            not reply
+            or not is_hello(reply)
+            or len(reply) != len(self.frame) + SALT_SIZE + choice_size + 32
+        ):
+            raise ConnectionError("session handshake failed")
+        server_part = reply[len(self.frame) : -32]
+        if not hmac.compare_digest(reply[-32:], _confirm(self.frame, server_part)):
+            raise ConnectionError("session handshake failed: key mismatch")
+        compression = None
+        if choice_size and server_part[-1]:
+            if server_part[-1] not in self.offers:
+                raise ConnectionError("session handshake failed: bad compression")
+            compression = COMPRESSIONS_BY_ID[server_part[-1]]
+        salt = self.salt + server_part[:SALT_SIZE]
+        return Session(
+            self.cipher_name,
+            _derive(salt, b"client"),
+            _derive(salt, b"server"),
+            compression,
+            self.compression_threshold,
+            self.max_message_size,
+        )
+
+
+def accept_hello(
+    frame,
+    compression_threshold=COMPRESSION_THRESHOLD,
+    max_message_size=DEFAULT_MAX_FRAME_SIZE,
+):
+    """Return (reply frame, Session) for a client hello, or (None, None) if
+    frame is not one and the peer is using Fernet."""
+    if not is_hello(frame):
+        return None, None
+    cipher_name = CIPHERS_BY_ID.get(frame[len(HELLO)])
+    salt_end = len(HELLO) + 1 + SALT_SIZE
+    if cipher_name is None or len(frame) < salt_end:
+        raise ValueError("unsupported session hello")
+    offers = frame[salt_end:]
+    server_salt = os.urandom(SALT_SIZE)
+    server_part = server_salt
+    compression = None
+    if offers:
+        # Clients that offer nothing predate compression and expect a
+        # reply without the choice byte.
+        compression = next(
+            (COMPRESSIONS_BY_ID[i] for i in offers if i in COMPRESSIONS_BY_ID), None
+        )
+        server_part += bytes((compression.id if compression else 0,))
+    salt = frame[len(HELLO) + 1 : salt_end] + server_salt
+    session = Session(
+        cipher_name,
+        _derive(salt, b"server"),
+        _derive(salt, b"client"),
+        compression,
+        compression_threshold,
+        max_message_size,
+    )
+    # The reply echoes the hello and proves the server holds the same key.
+    return frame + server_part + _confirm(frame, server_part), session
@@ -0,0 +1,147 @@
+import asyncio
+import struct
+
+HEADER = struct.Struct("!I")
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+# Above this size the header and payload go out in separate sendall calls
+# instead of being concatenated into a new bytes object.
+_COPY_THRESHOLD = 64 * 1024
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(payload, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    if len(payload) > max_frame_size:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds {max_frame_size}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    if len(payload) <= _COPY_THRESHOLD:
+        sock.sendall(encode_frame(payload, max_frame_size))
+        return
+    if len(payload) > max_frame_size:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds {max_frame_size}")
+    sock.sendall(HEADER.pack(len(payload)))
+    sock.sendall(payload)
+
+
+async def read_frame_async(reader, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+    """Read one frame from an asyncio StreamReader; None at a clean EOF."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise FrameError("connection closed mid-frame")
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > max_frame_size:
+        raise FrameError(f"frame of {length} bytes exceeds {max_frame_size}")
+    return await reader.readexactly(length)
+
+
+class FrameDecoder:
+    """Incremental decoder for length-prefixed frames.
+
+    Bytes are received straight into a reusable bytearray (see writable and
+    advance), and each complete frame is copied out exactly once.
+    """
+
+    def __init__(
+        self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, buffer_size=DEFAULT_BUFFER_SIZE
+    ):
+        self.max_frame_size = max_frame_size
+        self._initial_size = buffer_size
+        self._buf = bytearray(buffer_size)
+        self._start = 0
+        self._end = 0
+
+    def buffered(self):
+        return self._end - self._start
+
+    def writable(self):
+        """Return a memoryview of free buffer space to receive into.
+
+        The caller must release the view before the next call.
+        """
+        needed = HEADER.size
+        if self.buffered() >= HEADER.size:
+            needed += self._peek_length()
+        if self._start and (
+            len(self._buf) - self._start < needed or self._end == len(self._buf)
+        ):
+            self._compact()
+        if len(self._buf) < needed:
+            self._buf.extend(bytes(needed - len(self._buf)))
+        elif self._end == len(self._buf):
+            self._buf.extend(bytes(self._initial_size))
+        return memoryview(self._buf)[self._end :]
+
+    def advance(self, n):
+        self._end += n
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            with self.writable() as target:
+                n = min(len(target), len(view))
+                target[:n] = view[:n]
+            self.advance(n)
+            view = view[n:]
+
+    def next_frame(self):
+        """Return the next complete frame, or None if more bytes are needed."""
+        if self.buffered() < HEADER.size:
+            return None
+        length = self._peek_length()
+        frame_end = self._start + HEADER.size + length
+        if frame_end > self._end:
+            return None
+        frame = bytes(memoryview(self._buf)[self._start + HEADER.size : frame_end])
+        self._start = frame_end
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _peek_length(self):
+        (length,) = HEADER.unpack_from(self._buf, self._start)
+        if length > self.max_frame_size:
+            raise FrameError(f"frame of {length} bytes exceeds {self.max_frame_size}")
+        return length
+
+    def _compact(self):
+        remaining = self.buffered()
+        self._buf[:remaining] = self._buf[self._start : self._end]
+        self._start, self._end = 0, remaining
+
+
+class FrameReader:
+    """Blocking frame reader for a socket, backed by a FrameDecoder."""
+
+    def __init__(self, sock, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_frame_size)
+
+    def read_frame(self):
+        """Return the next frame, or None once the peer closes the connection."""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            with self.decoder.writable() as target:
+                n = self.sock.recv_into(target)
+            if not n:
+                if self.decoder.buffered():
+                    raise FrameError("connection closed mid-frame")
+                return None
+            self.decoder.advance(n)
@@ -0,0 +1,237 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets: powers of two from 1us to ~19h, so
+# one layout covers both crypto calls and time spent queued.
+LATENCY_BUCKETS = tuple(2**i / 1e6 for i in range(37))
+
+
+class _Cell:
+    __slots__ = ("values", "__weakref__")
+
+    def __init__(self, size):
+        self.values = [0] * size
+
+
+class ThreadCounts:
+    """A vector of numbers that threads add to without taking a lock.
+
+    Each thread adds into its own list. A thread's list is folded into the
+    retired totals when the thread exits, so per-connection threads don't
+    pile up. totals() may miss adds that are in flight while it runs.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._live = {}
+        self._retired = [0] * size
+
+    def values(self):
+        """This thread's list; callers add to its items in place."""
+        try:
+            return self._local.cell.values
+        except AttributeError:
+            cell = _Cell(self.size)
+            with self._lock:
+                self._live[id(cell.values)] = cell.values
+            weakref.finalize(cell, self._retire, cell.values)
+            self._local.cell = cell
+            return cell.values
+
+    def _retire(self, values):
+        with self._lock:
+            self._live.pop(id(values), None)
+            for i, value in enumerate(values):
+                self._retired[i] += value
+
+    def totals(self):
+        with self._lock:
+            totals = list(self._retired)
+            for values in self._live.values():
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return totals
+
+
+class Counter:
+    def __init__(self):
+        self.counts = ThreadCounts(1)
+
+    def inc(self, n=1):
+        self.counts.values()[0] += n
+
+    @property
+    def value(self):
+        return self.counts.totals()[0]
+
+
+class Histogram:
+    """Bucketed distribution of durations in seconds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One slot per bucket, one for overflow, and the running sum.
+        self.counts = ThreadCounts(len(bounds) + 2)
+
+    def observe(self, seconds):
+        values = self.counts.values()
+        values[bisect_left(self.bounds, seconds)] += 1
+        values[-1] += seconds
+
+    def snapshot(self):
+        totals = self.counts.totals()
+        buckets, total = totals[:-1], totals[-1]
+        count = sum(buckets)
+        return {
+            "count": count,
+            "sum": total,
+            "buckets": buckets,
+            "p50": self._quantile(buckets, count, 0.5),
+            "p99": self._quantile(buckets, count, 0.99),
+            "p999": self._quantile(buckets, count, 0.999),
+        }
+
+    def _quantile(self, buckets, count, q):
+        """Upper bound of the bucket holding the q-th observation."""
+        if not count:
+            return None
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= q * count:
+                return self.bounds[i] if i < len(self.bounds) else float("inf")
+        return float("inf")
+
+
+class Metrics:
+    """Named counters, histograms and gauges, each optionally split by a label.
+
+    Recording takes no lock once a series exists. Gauges are callables that
+    return {label: value} and are only evaluated on read.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def counter(self, name, label=None):
+        counter = self.counters.get((name, label))
+        if counter is None:
+            counter = self.counters.setdefault((name, label), Counter())
+        return counter
+
+    def histogram(self, name, label=None):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms.setdefault((name, label), Histogram())
+        return histogram
+
+    def inc(self, name, n=1, label=None):
+        self.counter(name, label).inc(n)
+
+    def observe(self, name, seconds, label=None):
+        self.histogram(name, label).observe(seconds)
+
+    @contextmanager
+    def timer(self, name, label=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, label)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def remove(self, name, label):
+        """Drop one labelled series, e.g. for a worker that has gone."""
+        self.counters.pop((name, label), None)
+        self.histograms.pop((name, label), None)
+
+    def snapshot(self):
+        """Every series as plain data; labelled series are nested by label."""
+        result = {
+            "uptime": time.time() - self.started,
+            "counters": {},
+            "histograms": {},
+            "gauges": {},
+        }
+        for (name, label), counter in list(self.counters.items()):
+            _put(result["counters"], name, label, counter.value)
+        for (name, label), histogram in list(self.histograms.items()):
+            snapshot = histogram.snapshot()
+            del snapshot["buckets"]
+            _put(result["histograms"], name, label, snapshot)
+        for name, read in list(self.gauges.items()):
+            for label, value in read().items():
+                _put(result["gauges"], name, label, value)
+        return result
+
+    def render_prometheus(self, prefix="taskqueue_"):
+        """The same series in the Prometheus text exposition format."""
+        lines = []
+        for (name, label), counter in sorted(
+            list(self.counters.items()), key=_series_key
+        ):
+            lines.append(f"{prefix}{name}_total{_labels(name, label)} {counter.value}")
+        for (name, label), histogram in sorted(
+            list(self.histograms.items()), key=_series_key
+        ):
+            snapshot = histogram.snapshot()
+            cumulative = 0
+            for bound, n in zip(histogram.bounds + ("+Inf",), snapshot["buckets"]):
+                cumulative += n
+                lines.append(
+                    f"{prefix}{name}_bucket{_labels(name, label, le=bound)} {cumulative}"
+                )
+            lines.append(f"{prefix}{name}_sum{_labels(name, label)} {snapshot['sum']}")
+            lines.append(
+                f"{prefix}{name}_count{_labels(name, label)} {snapshot['count']}"
+            )
+        for name, read in sorted(list(self.gauges.items())):
+            for label, value in sorted(read().items(), key=str):
+                lines.append(f"{prefix}{name}{_labels(name, label)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _put(series, name, label, value):
+    if label is None:
+        series[name] = value
+    else:
+        series.setdefault(name, {})[str(label)] = value
+
+
+def _series_key(item):
+    name, label = item[0]
+    return name, str(label)
+
+
+# The label name each series is split by in the Prometheus output.
+LABEL_NAMES = {
+    "request_seconds": "type",
+    "crypto_seconds": "op",
+    "worker_tasks_completed": "worker",
+    "queue_depth": "priority",
+}
+
+
+def _labels(name, label, le=None):
+    pairs = []
+    if label is not None:
+        pairs.append((LABEL_NAMES.get(name, "label"), label))
+    if le is not None:
+        pairs.append(("le", le))
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
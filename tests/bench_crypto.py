@@ -0,0 +1,109 @@
+import argparse
+import random
+import time
+from shared.codec import CODECS
+from shared.compression import COMPRESSIONS
+from shared.encryption import (
+    CIPHERS,
+    DEFAULT_CIPHER,
+    ClientHello,
+    accept_hello,
+    add_hmac,
+    decrypt_message,
+    encrypt_message,
+    seal,
+    unseal,
+    verify_hmac,
+)
+
+
+def document(size):
+    """A JSON-like document of about size bytes, compressible like real ones."""
+    rng = random.Random(size)
+    records, total = [], 0
+    while total < size:
+        record = {
+            "id": rng.randrange(10**9),
+            "name": rng.choice(["alpha", "beta", "gamma", "delta"]),
+            "score": round(rng.random(), 4),
+        }
+        records.append(record)
+        total += 48
+    return records
+
+
+def message(payload_size):
+    return {
+        "type": "task_completed",
+        "task_id": "5a8329cf-591f-4be9-911a-d4302d54ba6f",
+        "worker_id": "worker-1234",
+        "request_id": 17,
+        "result": {"document": document(payload_size)},
+    }
+
+
+def legacy_round_trip(msg):
+    frame = encrypt_message(add_hmac(msg))
+    verify_hmac(decrypt_message(frame))
+    return frame
+
+
+def fernet_round_trip(codec):
+    def round_trip(msg):
+        frame = seal(msg, codec)
+        unseal(frame)
+        return frame
+
+    return round_trip
+
+
+def session_round_trip(cipher_name, codec, compression="none"):
+    hello = ClientHello(cipher_name, compression)
+    reply, server = accept_hello(hello.frame)
+    client = hello.finish(reply)
+
+    def round_trip(msg):
+        frame = client.seal(msg, codec)
+        server.unseal(frame)
+        return frame
+
+    return round_trip
+
+
+def measure(round_trip, msg, iterations):
+    frame = round_trip(msg)
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        round_trip(msg)
+    return (time.perf_counter() - start_time) / iterations * 1e6, len(frame)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark message sealing modes")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 2048, 65536])
+    args = parser.parse_args()
+
+    modes = [("fernet+hmac (legacy)", legacy_round_trip)]
+    for codec in sorted(CODECS):
+        modes.append((f"fernet/{codec}", fernet_round_trip(codec)))
+    for cipher_name in sorted(CIPHERS):
+        for codec in sorted(CODECS):
+            modes.append(
+                (f"{cipher_name}/{codec}", session_round_trip(cipher_name, codec))
+            )
+    for compression in COMPRESSIONS:
+        for codec in sorted(CODECS):
+            modes.append(
+                (
+                    f"{DEFAULT_CIPHER}/{codec}/{compression}",
+                    session_round_trip(DEFAULT_CIPHER, codec, compression),
+                )
+            )
+
+    for size in args.sizes:
+        msg = message(size)
+        print(f"payload {size} bytes:")
+        for name, round_trip in modes:
+            micros, frame_size = measure(round_trip, msg, args.iterations)
+            print(f"  {name:28} {micros:8.1f} us/msg  {frame_size:7d} bytes on wire")
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import functools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Servers started as subprocesses have to share the harness's key, so pick
+# one before shared.encryption is imported.
+os.environ.setdefault(
+    "TASKQUEUE_KEY", base64.urlsafe_b64encode(os.urandom(32)).decode("ascii")
+)
+
+from client.async_client import AsyncClient
+from definitions.scheduler import DEFAULT_SCHEDULER, SCHEDULERS
+from worker.worker import Worker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def simulated_task(task, slowdown=1):
+    """Task handler for the bench workers: sleep for the task's service time."""
+    time.sleep(task["work"] * slowdown)
+    return {"size": len(task["payload"])}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_server(args, port, directory):
+    """Start the server in this process or as a subprocess; returns a stop function."""
+    if args.subprocess:
+        command = [sys.executable, "-m", "server.task_server", "--port", str(port)]
+        command += ["--metrics-port", "0", "--scheduler", args.scheduler]
+        if args.use_async:
+            command.append("--async")
+        if args.processes > 1:
+            command += ["--processes", str(args.processes)]
+            command += ["--queue-socket", os.path.join(directory, "queue.sock")]
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        process = subprocess.Popen(
+            command,
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wait_for_port(port)
+
+        def stop():
+            process.terminate()
+            process.wait(timeout=10)
+
+        return stop
+
+    # The queue log goes to the working directory.
+    os.chdir(directory)
+    if args.use_async:
+        from server.async_server import AsyncTaskQueueServer as server_class
+    else:
+        from server.task_server import TaskQueueServer as server_class
+    server = server_class(host="127.0.0.1", port=port, scheduler=args.scheduler)
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    wait_for_port(port)
+    return server.shutdown
+
+
+def start_workers(args, port):
+    workers = []
+    for i in range(args.workers):
+        # The first --slow-workers run every task --slowdown times longer.
+        slowdown = args.slowdown if i < args.slow_workers else 1
+        worker = Worker(
+            server_port=port,
+            concurrency=args.concurrency,
+            prefetch=args.prefetch,
+            task_handler=functools.partial(simulated_task, slowdown=slowdown),
+        )
+        thread = threading.Thread(target=worker.start)
+        thread.daemon = True
+        thread.start()
+        workers.append(worker)
+    return workers
+
+
+def parse_mix(spec):
+    """Split a weighted mix like 0:0.8,5:0.2 into priorities and weights."""
+    priorities, weights = [], []
+    for part in spec.split(","):
+        priority, _, weight = part.partition(":")
+        priorities.append(int(priority))
+        weights.append(float(weight or 1))
+    return priorities, weights
+
+
+class Workload:
+    """Random task specs plus the latency samples collected for them."""
+
+    def __init__(self, args):
+        self.payload_sizes = args.payload_sizes
+        self.priorities, self.weights = parse_mix(args.priorities)
+        self.service_time = args.service_time
+        self.task_timeout = args.task_timeout
+        self.result_timeout = args.result_timeout
+        self.enqueue_latencies = []
+        self.end_to_end_latencies = []
+        self.errors = 0
+
+    def next_task(self):
+        return (
+            {
+                "work": (
+                    random.expovariate(1 / self.service_time)
+                    if self.service_time
+                    else 0
+                ),
+                "payload": "x" * random.choice(self.payload_sizes),
+            },
+            random.choices(self.priorities, self.weights)[0],
+        )
+
+    async def run_one(self, client, started):
+        """Enqueue one task and wait for its result; latencies count from started."""
+        task, priority = self.next_task()
+        task_id = await client.add_task(task, priority, self.task_timeout)
+        if task_id is None:
+            self.errors += 1
+            return
+        self.enqueue_latencies.append(time.perf_counter() - started)
+        if await client.wait_result(task_id, self.result_timeout) is None:
+            self.errors += 1
+            return
+        self.end_to_end_latencies.append(time.perf_counter() - started)
+
+
+async def closed_loop(client, workload, users, duration):
+    """users clients that each enqueue a task, wait for it, then go again."""
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            await workload.run_one(client, time.perf_counter())
+
+    await asyncio.gather(*(user() for _ in range(users)))
+
+
+async def open_loop(client, workload, rate, duration):
+    """Poisson arrivals at rate tasks/s whether or not earlier ones finished.
+
+    Latency counts from each task's scheduled arrival, so a stalled server
+    shows up in the numbers instead of slowing the arrivals down.
+    """
+    start_time = time.perf_counter()
+    arrival = start_time
+    pending = []
+    while arrival < start_time + duration:
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        pending.append(asyncio.create_task(workload.run_one(client, arrival)))
+        arrival += random.expovariate(rate)
+    await asyncio.gather(*pending)
+
+
+def summarize(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+
+    def quantile(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": quantile(0.5),
+        "p99": quantile(0.99),
+        "p999": quantile(0.999),
+        "max": samples[-1],
+    }
+
+
+async def run_workload(args, port, mode):
+    workload = Workload(args)
+    async with AsyncClient(
+        server_port=port, pool_size=args.connections, timeout=args.result_timeout
+    ) as client:
+        start_time = time.perf_counter()
+        if mode == "closed":
+            await closed_loop(client, workload, args.users, args.duration)
+        else:
+            await open_loop(client, workload, args.rate, args.duration)
+        elapsed = time.perf_counter() - start_time
+    return {
+        "elapsed": elapsed,
+        "enqueued": len(workload.enqueue_latencies),
+        "completed": len(workload.end_to_end_latencies),
+        "errors": workload.errors,
+        "throughput": len(workload.end_to_end_latencies) / elapsed,
+        "enqueue_latency": summarize(workload.enqueue_latencies),
+        "end_to_end_latency": summarize(workload.end_to_end_latencies),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    port = args.port or free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        stop_server = start_server(args, port, directory)
+        workers = start_workers(args, port)
+        try:
+            results = {}
+            for mode in args.modes:
+                results[mode] = asyncio.run(run_workload(args, port, mode))
+        finally:
+            for worker in workers:
+                worker.stop()
+            stop_server()
+            os.chdir(cwd)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load-test a task queue server with workers on localhost"
+    )
+    parser.add_argument("--modes", nargs="+", choices=["closed", "open"])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=32, help="closed-loop clients")
+    parser.add_argument("--rate", type=float, default=200, help="open-loop tasks/s")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[64])
+    parser.add_argument(
+        "--priorities", default="0", help="weighted mix, e.g. 0:0.8,5:0.2"
+    )
+    parser.add_argument(
+        "--service-time", type=float, default=0.001, help="mean seconds per task"
+    )
+    parser.add_argument("--task-timeout", type=float, default=300)
+    parser.add_argument("--result-timeout", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--slow-workers", type=int, default=0)
+    parser.add_argument("--slowdown", type=float, default=10)
+    parser.add_argument(
+        "--scheduler", choices=sorted(SCHEDULERS), default=DEFAULT_SCHEDULER
+    )
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument(
+        "--subprocess", action="store_true", help="run the server as a subprocess"
+    )
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here too")
+    args = parser.parse_args()
+    args.modes = args.modes or ["closed", "open"]
+    if args.processes > 1:
+        args.subprocess = True
+
+    # Server, workers and clients all print per task; keep stdout for the report.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run(args)
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,77 @@
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from definitions.task_queue import TaskQueue
+
+
+def open_queue(directory):
+    # Compaction is left out so the numbers cover the queue structures and
+    # the log append path only.
+    return TaskQueue(
+        os.path.join(directory, "tasks.json"), fsync=False, compact_threshold=10**12
+    )
+
+
+def fill(queue, num_tasks, batch_size):
+    for start in range(0, num_tasks, batch_size):
+        end = min(start + batch_size, num_tasks)
+        queue.add_tasks([(i % 3, f"payload {i}", 3600) for i in range(start, end)])
+
+
+def drain(queue, batch_size):
+    drained = 0
+    while True:
+        tasks = queue.get_tasks(batch_size)
+        if not tasks:
+            return drained
+        for task in tasks:
+            queue.complete_task(task.task_id)
+        drained += len(tasks)
+
+
+def measure_memory(num_tasks, batch_size):
+    with tempfile.TemporaryDirectory() as directory:
+        queue = open_queue(directory)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        fill(queue, num_tasks, batch_size)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        queue.close()
+    return (after - before) / num_tasks
+
+
+def measure_throughput(num_tasks, batch_size):
+    with tempfile.TemporaryDirectory() as directory:
+        queue = open_queue(directory)
+        start_time = time.time()
+        fill(queue, num_tasks, batch_size)
+        enqueue_time = time.time() - start_time
+        start_time = time.time()
+        drained = drain(queue, batch_size)
+        drain_time = time.time() - start_time
+        queue.close()
+    if drained != num_tasks:
+        print(f"warning: drained {drained} of {num_tasks} tasks")
+    return num_tasks / enqueue_time, num_tasks / drain_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark TaskQueue memory and speed")
+    parser.add_argument("--tasks", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    bytes_per_task = measure_memory(args.tasks, args.batch_size)
+    enqueue_rate, drain_rate = measure_throughput(args.tasks, args.batch_size)
+    print(
+        f"tasks: {args.tasks}\nbatch size: {args.batch_size}\n"
+        f"bytes per queued task: {bytes_per_task:.0f}\n"
+        f"enqueue: {enqueue_rate:.0f} tasks/s\n"
+        f"dequeue + complete: {drain_rate:.0f} tasks/s"
+    )
@@ -3,8 +3,18 @@ import time
 from client.client import Client
 
 
-def worker(client, num_tasks):
+def worker(client, num_tasks, batch_size=1):
     try:
+        if batch_size > 1:
+            for start in range(0, num_tasks, batch_size):
+                end = min(start + batch_size, num_tasks)
+                print(f"adding tasks {start}-{end - 1}")
+                client.add_tasks(
+                    [f"load test task {i}" for i in range(start, end)],
+                    priority=1,
+                    timeout=300,
+                )
+            return
         for i in range(num_tasks):
             print(f"adding task {i}")  # Optionally, reduce verbosity in production
             client.add_task(f"load test task {i}", priority=1, timeout=300)
@@ -12,7 +22,7 @@ def worker(client, num_tasks):
         print(f"error in worker thread: {e}")
 
 
-def run_load_test(num_clients, tasks_per_client):
+def run_load_test(num_clients, tasks_per_client, batch_size=1):
     clients = [Client() for _ in range(num_clients)]
     threads = []
     lock = threading.Lock()  # Lock for managing output if needed
@@ -22,7 +32,9 @@ def run_load_test(num_clients, tasks_per_client):
         # Using the lock to prevent jumbled outputs
         with lock:
             print(f"starting client {idx + 1}")
-        thread = threading.Thread(target=worker, args=(client, tasks_per_client))
+        thread = threading.Thread(
+            target=worker, args=(client, tasks_per_client, batch_size)
+        )
         threads.append(thread)
         thread.start()
 
@@ -43,3 +55,4 @@ def run_load_test(num_clients, tasks_per_client):
 if __name__ == "__main__":
     print("processing test...")
     run_load_test(num_clients=10, tasks_per_client=100)
+    run_load_test(num_clients=10, tasks_per_client=100, batch_size=100)
@@ -0,0 +1,175 @@
+import heapq
+import pickle
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+
+# Tasks that are dicts pick their handler by this field; anything else goes
+# to the registry's default handler.
+TASK_TYPE_FIELD = "type"
+
+KINDS = ("thread", "process", "async")
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class Handler:
+    """A task function and where it runs.
+
+    kind is "thread" for I/O-bound functions, "process" for CPU-bound ones
+    (the function must be picklable, i.e. defined at module level) and
+    "async" for coroutine functions. timeout, if set, overrides the task's.
+    """
+
+    __slots__ = ("func", "kind", "timeout")
+
+    def __init__(self, func, kind="thread", timeout=None):
+        if kind not in KINDS:
+            raise ValueError(f"unknown handler kind: {kind}")
+        self.func = func
+        self.kind = kind
+        self.timeout = timeout
+
+
+class HandlerRegistry:
+    def __init__(self, default=None):
+        self.handlers = {}
+        self.default = default
+
+    def register(self, task_type, func=None, kind="thread", timeout=None):
+        """Register func for task_type; without func, returns a decorator."""
+        if func is None:
+            return lambda func: self.register(task_type, func, kind, timeout)
+        self.handlers[task_type] = Handler(func, kind, timeout)
+        return func
+
+    def resolve(self, task):
+        """task's handler, else the default one (None if there is none)."""
+        if isinstance(task, dict):
+            handler = self.handlers.get(task.get(TASK_TYPE_FIELD))
+            if handler is not None:
+                return handler
+        return self.default
+
+
+registry = HandlerRegistry()
+
+
+def handler(task_type, kind="thread", timeout=None):
+    """Decorator registering a function in the module-level registry."""
+    return registry.register(task_type, kind=kind, timeout=timeout)
+
+
+class Deadlines:
+    """One thread that calls expire callbacks once their deadline passes.
+
+    Cheaper than a threading.Timer per task; cancelled entries are skipped
+    when they surface.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.order = 0
+        self.cond = threading.Condition()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, seconds, expire):
+        """Schedule expire(); returns an entry to pass to cancel()."""
+        with self.cond:
+            self.order += 1
+            entry = [time.monotonic() + seconds, self.order, expire]
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    self.cond.wait(timeout)
+                _, _, expire = heapq.heappop(self.heap)
+            if expire is not None:
+                try:
+                    expire()
+                except Exception as e:
+                    print(f"Error expiring task: {e}")
+
+
+# Process-pool side. Payloads above the worker's threshold travel through
+# shared memory: the parent pickles the task straight into a segment and
+# the pool process unpickles it from there, so the executor's pipe only
+# carries the segment name. Large results come back the same way.
+
+
+class SharedPayload:
+    __slots__ = ("name", "size")
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+def share(value, threshold):
+    """value, or a SharedPayload holding it if it pickles to threshold bytes or more."""
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) < threshold:
+        return value
+    segment = shared_memory.SharedMemory(create=True, size=len(data))
+    segment.buf[: len(data)] = data
+    payload = SharedPayload(segment.name, len(data))
+    segment.close()
+    return payload
+
+
+def unshare(value, unlink=True):
+    if not isinstance(value, SharedPayload):
+        return value
+    segment = shared_memory.SharedMemory(name=value.name)
+    try:
+        return pickle.loads(segment.buf[: value.size])
+    finally:
+        segment.close()
+        if unlink:
+            segment.unlink()
+
+
+def release(value):
+    """Free a SharedPayload's segment once nothing will read it."""
+    if isinstance(value, SharedPayload):
+        try:
+            segment = shared_memory.SharedMemory(name=value.name)
+        except FileNotFoundError:
+            return
+        segment.close()
+        segment.unlink()
+
+
+def _raise_timeout(signum, frame):
+    raise TaskTimeout("task timed out")
+
+
+def run_in_process(func, task, timeout, threshold):
+    """Run func in a pool process, interrupting it after timeout seconds."""
+    task = unshare(task, unlink=False)
+    # Pool processes run tasks on their main thread, so a timer signal can
+    # interrupt the handler without killing the process.
+    alarm = timeout and hasattr(signal, "setitimer")
+    if alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        result = func(task)
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return share(result, threshold)
@@ -1,25 +1,104 @@
+import argparse
+import asyncio
+import importlib
 import socket
-import json
 import time
 import random
 import threading
-from shared.encryption import encrypt_message, decrypt_message, add_hmac, verify_hmac
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from shared.codec import CODECS, DEFAULT_CODEC
+from shared.compression import COMPRESSIONS, DEFAULT_COMPRESSION
+from shared.encryption import CIPHERS, DEFAULT_CIPHER, ClientHello, seal, unseal
+from shared.framing import DEFAULT_MAX_FRAME_SIZE, FrameReader, send_frame
 from definitions.worker import Worker as WorkerDef
+from worker.handlers import (
+    Deadlines,
+    Handler,
+    TaskTimeout,
+    registry,
+    release,
+    run_in_process,
+    share,
+    unshare,
+)
+
+
+def process_task(task):
+    try:
+        time.sleep(random.uniform(1, 5))
+        return {"result": "processed"}
+
+    except Exception as e:
+        print(f"Task processing error: {e}")
+        return f"Error processing task: {str(e)}"
+
+
+def timed_out(seconds):
+    future = Future()
+    future.set_exception(TaskTimeout(f"task timed out after {seconds}s"))
+    return future
 
 
 class Worker(WorkerDef):
     def __init__(
-        self, server_host="localhost", server_port=5000, max_retries=3, backoff_factor=2
+        self,
+        server_host="localhost",
+        server_port=5000,
+        max_retries=3,
+        backoff_factor=2,
+        max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+        poll_wait=20,
+        heartbeat_interval=10,
+        concurrency=1,
+        prefetch=0,
+        use_processes=False,
+        task_handler=process_task,
+        codec=DEFAULT_CODEC,
+        cipher=DEFAULT_CIPHER,
+        compression=DEFAULT_COMPRESSION,
+        handlers=None,
+        shm_threshold=64 * 1024,
     ):
         super().__init__(None, None)
         self.server_host = server_host
         self.server_port = server_port
         self.max_retries = max_retries
         self.backoff_factor = backoff_factor
+        self.max_frame_size = max_frame_size
+        self.poll_wait = poll_wait
+        # Any frame counts as a heartbeat, so one is only sent when every
+        # slot has been busy this long without a completion going out.
+        self.heartbeat_interval = heartbeat_interval
+        self.concurrency = max(1, concurrency)
+        self.prefetch = max(0, prefetch)
+        # Tasks beyond the running slots wait in the executor's queue, so
+        # the server never hands this worker more than it has room for.
+        self.capacity = self.concurrency + self.prefetch
+        self.use_processes = use_processes
+        self.task_handler = task_handler
+        # Tasks whose type has no registered handler run task_handler.
+        # Bound methods can't be pickled, so processes get it directly.
+        self.handlers = registry if handlers is None else handlers
+        if use_processes:
+            self.default_handler = Handler(task_handler, "process")
+        else:
+            self.default_handler = Handler(self.process_task, "thread")
+        self.shm_threshold = shm_threshold
+        self.process_pool = None
+        self.loop = None
+        self.deadlines = None
+        self.codec = codec
+        self.cipher = cipher
+        self.compression = compression
+        self.session = None
+        self.executor = None
+        self.leased = 0
+        self._leases = threading.Condition()
         self.worker_id = f"worker-{random.randint(1000, 9999)}"
         self.running = True
         self.sock = None
-        self.heartbeat_thread = None
+        self.reader = None
         self._lock = threading.Lock()
 
     def connect_with_retry(self):
@@ -35,6 +114,16 @@ class Worker(WorkerDef):
 
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.server_host, self.server_port))
+                self.reader = FrameReader(self.sock, self.max_frame_size)
+                self.session = None
+                if self.cipher != "fernet":
+                    hello = ClientHello(
+                        self.cipher,
+                        self.compression,
+                        max_message_size=self.max_frame_size,
+                    )
+                    send_frame(self.sock, hello.frame, self.max_frame_size)
+                    self.session = hello.finish(self.reader.read_frame())
                 return True
             except socket.error as e:
                 print(f"Connection error: {e}")
@@ -50,28 +139,37 @@ class Worker(WorkerDef):
             try:
                 if not self.sock:
                     return False
-                hmac_message = add_hmac(message)
-                encrypted = encrypt_message(hmac_message)
-                self.sock.sendall(encrypted)
+                if self.session:
+                    encrypted = self.session.seal(message, self.codec)
+                else:
+                    encrypted = seal(message, self.codec)
+                send_frame(self.sock, encrypted, self.max_frame_size)
                 return True
             except (socket.error, Exception) as e:
                 print(f"Send error: {e}")
                 return False
-            
-    def receive_message(self):
+
+    def receive_message(self, reply_to=None):
+        """Read the next response, skipping acks for other request types."""
         try:
             if not self.sock:
                 return None
-            self.sock.settimeout(30)  # 30 second timeout
-            encrypted_response = self.sock.recv(1024)
-            if not encrypted_response:
-                return None
+            # A long-polled get_task may legitimately take poll_wait seconds.
+            self.sock.settimeout(self.poll_wait + 30)
+            while True:
+                encrypted_response = self.reader.read_frame()
+                if not encrypted_response:
+                    return None
 
-            response = decrypt_message(encrypted_response)
-            if not verify_hmac(response):
-                print("Invalid HMAC in server response")
-                return None
-            return response
+                if self.session:
+                    response = self.session.unseal(encrypted_response)
+                else:
+                    response = unseal(encrypted_response)
+                if response is None:
+                    print("Invalid server response")
+                    return None
+                if reply_to is None or response.get("reply_to", reply_to) == reply_to:
+                    return response
         except socket.timeout:
             print("Receive timeout")
             return None
@@ -79,42 +177,136 @@ class Worker(WorkerDef):
             print(f"Receive error: {e}")
             return None
 
+    def process_task(self, task):
+        return self.task_handler(task)
 
-    def send_heartbeats(self):
-        while self.running:
-            try:
-                if self.sock:
-                    heartbeat_msg = {"type": "heartbeat", "worker_id": self.worker_id}
-                    if not self.send_message(heartbeat_msg):
-                        break
-                time.sleep(10)
-            except Exception as e:
-                print(f"Heartbeat error: {e}")
-                break
+    def run_task(self, task_id, task, timeout=None):
+        print(f"Processing task {task_id}: {task}")
+        handler = self.handlers.resolve(task) or self.default_handler
+        timeout = handler.timeout or timeout
+        try:
+            future = self.submit(handler, task, timeout)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        finished = threading.Lock()
 
-    def process_task(self, task):
+        def finish(done):
+            if finished.acquire(blocking=False):
+                self.finish_task(task_id, done)
+            elif not done.cancelled() and done.exception() is None:
+                # Finished after its timeout was reported; nobody reads it.
+                release(done.result())
+
+        if timeout and handler.kind != "async":
+            # A thread can't be interrupted, and a pool process stuck in C
+            # code ignores its alarm, so stop waiting and report the timeout.
+            # The work itself runs on and its result is dropped.
+            grace = 1 if handler.kind == "process" else 0
+            expiry = self.deadlines.add(
+                timeout + grace, lambda: finish(timed_out(timeout))
+            )
+            future.add_done_callback(lambda done: self.deadlines.cancel(expiry))
+        future.add_done_callback(finish)
+
+    def submit(self, handler, task, timeout=None):
+        if handler.kind == "thread":
+            return self.executor.submit(handler.func, task)
+        if handler.kind == "async":
+            return asyncio.run_coroutine_threadsafe(
+                self.run_async(handler.func, task, timeout), self.event_loop()
+            )
+        payload = share(task, self.shm_threshold)
+        future = self.pool().submit(
+            run_in_process, handler.func, payload, timeout, self.shm_threshold
+        )
+        future.add_done_callback(lambda done: release(payload))
+        return future
+
+    async def run_async(self, func, task, timeout):
         try:
-            time.sleep(random.uniform(1, 5))  
-            return {"result": "processed"}
+            return await asyncio.wait_for(func(task), timeout)
+        except asyncio.TimeoutError:
+            raise TaskTimeout(f"task timed out after {timeout}s")
+
+    def pool(self):
+        with self._lock:
+            if self.process_pool is None:
+                # Start the tracker before forking so pool processes share it
+                # and segments they create are not reported as leaked.
+                resource_tracker.ensure_running()
+                self.process_pool = ProcessPoolExecutor(max_workers=self.concurrency)
+            return self.process_pool
+
+    def event_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever)
+                thread.daemon = True
+                thread.start()
+            return self.loop
 
+    def finish_task(self, task_id, future):
+        try:
+            result = unshare(future.result())
         except Exception as e:
             print(f"Task processing error: {e}")
-            return f"Error processing task: {str(e)}"
+            result = f"Error processing task: {str(e)}"
+        try:
+            completion_msg = {
+                "type": "task_completed",
+                "task_id": task_id,
+                "worker_id": self.worker_id,
+                "result": result,
+            }
+            if self.send_message(completion_msg):
+                print(completion_msg)
+                print(f"Task {task_id} completed")
+        finally:
+            with self._leases:
+                self.leased -= 1
+                self._leases.notify_all()
+
+    def fetch_tasks(self, max_n):
+        """Lease up to max_n tasks in one round trip; returns the raw response."""
+        request = {
+            "type": "get_tasks",
+            "worker_id": self.worker_id,
+            "max_n": max(1, max_n),
+            "wait": self.poll_wait,
+            "capacity": self.capacity,
+        }
+        if not self.send_message(request):
+            return None
+        return self.receive_message("get_tasks")
+
+    def wait_for_slot(self, timeout=None):
+        with self._leases:
+            return self._leases.wait_for(
+                lambda: self.leased < self.capacity or not self.running, timeout
+            )
 
     def process_invalid_response(self, retries):
         if retries >= self.max_retries:
             print(f"Too many invalid responses, skipping task.")
-            return False  
+            return False
         else:
-            wait_time = self.backoff_factor ** retries + random.uniform(0, 1)
-            print(f"Retrying task after {wait_time:.2f}s due to invalid response (attempt {retries+1})")
-            time.sleep(wait_time)  
+            wait_time = self.backoff_factor**retries + random.uniform(0, 1)
+            print(
+                f"Retrying task after {wait_time:.2f}s due to invalid response (attempt {retries+1})"
+            )
+            time.sleep(wait_time)
             return True
 
     def start(self):
         """Main worker loop"""
         self.running = True
-        retries = 0  
+        retries = 0
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        if self.deadlines is None:
+            self.deadlines = Deadlines()
 
         while self.running:
             try:
@@ -125,56 +317,49 @@ class Worker(WorkerDef):
 
                 print(f"Worker {self.worker_id} connected")
 
-                if (
-                    self.heartbeat_thread is None
-                    or not self.heartbeat_thread.is_alive()
-                ):
-                    self.heartbeat_thread = threading.Thread(
-                        target=self.send_heartbeats
-                    )
-                    self.heartbeat_thread.daemon = True
-                    self.heartbeat_thread.start()
-
                 while self.running:
-                    request = {"type": "get_task", "worker_id": self.worker_id}
-                    if not self.send_message(request):
+                    if not self.wait_for_slot(self.heartbeat_interval):
+                        heartbeat = {"type": "heartbeat", "worker_id": self.worker_id}
+                        if not self.send_message(heartbeat):
+                            break
+                        continue
+                    if not self.running:
                         break
-
-                    response = self.receive_message()
+                    response = self.fetch_tasks(self.capacity - self.leased)
                     if not response:
                         break
-                    
-                    if 'status' not in response or 'task_id' not in response or 'task' not in response:
+
+                    if response.get("status") == "empty":
+                        # The server already held the request for poll_wait
+                        # seconds, so ask again straight away.
+                        continue
+
+                    if response.get("status") == "busy":
+                        # The server still counts a completion we sent as
+                        # outstanding; give it a moment to catch up.
+                        with self._leases:
+                            self._leases.wait(1)
+                        continue
+
+                    if response.get("status") != "ok" or not isinstance(
+                        response.get("tasks"), list
+                    ):
                         print(f"Invalid response: {response}")
                         if not self.process_invalid_response(retries):
-                            break  
-                        retries += 1  
-                        continue  
-
-                    retries = 0  
-
-                    if response["status"] == "ok":
-                        task_id = response['task_id']
-                        task = response['task']
-                        print(f"Processing task {task_id}: {task}")
-                        result = self.process_task(task)
-
-                        completion_msg = {
-                            "type": "task_completed",
-                            "task_id": task_id,
-                            "worker_id": self.worker_id,
-                            "result": result,
-                        }
-                        if not self.send_message(completion_msg):
                             break
-                        print(completion_msg)
-                        print(f"Task {task_id} completed")
+                        retries += 1
+                        continue
 
-                    elif response["status"] == "empty":
-                        print("No tasks available, waiting...")
-                        time.sleep(5)
-                    else:
-                        print(f"Unexpected response: {response}")
+                    retries = 0
+
+                    with self._leases:
+                        self.leased += len(response["tasks"])
+                    for leased_task in response["tasks"]:
+                        self.run_task(
+                            leased_task["task_id"],
+                            leased_task["task"],
+                            leased_task.get("timeout"),
+                        )
 
             except Exception as e:
                 print(f"Worker error: {e}")
@@ -185,21 +370,81 @@ class Worker(WorkerDef):
                     except:
                         pass
                     self.sock = None
-                time.sleep(5)  
+                time.sleep(5)
 
     def stop(self):
         self.running = False
+        with self._leases:
+            self._leases.notify_all()
         if self.sock:
             try:
                 self.sock.close()
             except:
                 pass
-        if self.heartbeat_thread:
-            self.heartbeat_thread.join(timeout=1)
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+            self.process_pool = None
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
 
 
 if __name__ == "__main__":
-    worker = Worker()
+    parser = argparse.ArgumentParser(description="Run a task queue worker")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="run tasks without a registered handler in a process pool",
+    )
+    parser.add_argument(
+        "--handlers",
+        action="append",
+        default=[],
+        metavar="MODULE",
+        help="import MODULE so its @handler functions are registered",
+    )
+    parser.add_argument("--shm-threshold", type=int, default=64 * 1024)
+    parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=10,
+        help="seconds with every slot busy before a heartbeat is sent",
+    )
+    parser.add_argument(
+        "--codec", choices=sorted(CODECS) + ["legacy"], default=DEFAULT_CODEC
+    )
+    parser.add_argument(
+        "--cipher", choices=sorted(CIPHERS) + ["fernet"], default=DEFAULT_CIPHER
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(COMPRESSIONS) + ["none"],
+        default=DEFAULT_COMPRESSION,
+        help="compress large messages; negotiated with the server",
+    )
+    args = parser.parse_args()
+    for module in args.handlers:
+        importlib.import_module(module)
+
+    worker = Worker(
+        server_host=args.host,
+        server_port=args.port,
+        concurrency=args.concurrency,
+        prefetch=args.prefetch,
+        use_processes=args.processes,
+        codec=args.codec,
+        cipher=args.cipher,
+        compression=args.compression,
+        shm_threshold=args.shm_threshold,
+        heartbeat_interval=args.heartbeat_interval,
+    )
     try:
         worker.start()
     except KeyboardInterrupt: